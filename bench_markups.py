@@ -0,0 +1,92 @@
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+import argparse
+import callbacks as cb
+import markups
+import timeit
+
+
+# the builders markups.py used before static markups and templates, kept here for comparison
+def group_menu():
+    builder = InlineKeyboardBuilder()
+    builder.add(
+        InlineKeyboardButton(text="➕ Создать задачу", callback_data=cb.CreateTask().pack()),
+        InlineKeyboardButton(text="📋 Все задачи", callback_data=cb.ListTasks().pack()),
+        InlineKeyboardButton(text="🗑 Удалить всё", callback_data=cb.DeleteAll().pack())
+    )
+    builder.adjust(3, 1)
+    return builder.as_markup()
+
+
+def reminder_menu(task_id):
+    builder = InlineKeyboardBuilder()
+    for minutes, text in markups.REMINDER_PERIODS:
+        builder.add(InlineKeyboardButton(text=text, callback_data=cb.SetReminder(task_id=task_id, minutes=minutes).pack()))
+    builder.adjust(2)
+    return builder.as_markup()
+
+
+def task_actions_menu(task_id, show_back=True):
+    builder = InlineKeyboardBuilder()
+    builder.add(
+        InlineKeyboardButton(text="⌛️ Перенести дату", callback_data=cb.Reschedule(task_id=task_id).pack()),
+        InlineKeyboardButton(text="➕ Изменить напоминание", callback_data=cb.AddReminder(task_id=task_id).pack()),
+        InlineKeyboardButton(text="🗑 Удалить", callback_data=cb.DeleteTask(task_id=task_id).pack())
+    )
+    if show_back:
+        builder.add(InlineKeyboardButton(text="🔙 Назад к списку", callback_data=cb.ListTasks().pack()))
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def tasks_pagination_menu(tasks, page=0, has_prev=False, has_next=False):
+    builder = InlineKeyboardBuilder()
+    for task in tasks:
+        builder.add(InlineKeyboardButton(text=f"#{task[0]}", callback_data=cb.ViewTask(task_id=task[0]).pack()))
+    pagination_buttons = []
+    if has_prev:
+        pagination_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=cb.TasksPage(page=page - 1).pack()))
+    pagination_buttons.append(InlineKeyboardButton(text="🏠 Главное меню", callback_data=cb.MainMenu().pack()))
+    if has_next:
+        pagination_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=cb.TasksPage(page=page + 1).pack()))
+    builder.row(*pagination_buttons)
+    return builder.as_markup()
+
+
+def digest_menu(task_ids):
+    builder = InlineKeyboardBuilder()
+    for task_id in task_ids:
+        builder.add(InlineKeyboardButton(text=f"✅ #{task_id}", callback_data=cb.ConfirmTask(task_id=task_id).pack()))
+    builder.adjust(4)
+    builder.row(InlineKeyboardButton(text="✅ Подтвердить все", callback_data=cb.ConfirmDigest().pack()))
+    return builder.as_markup()
+
+
+CASES = [
+    ("group_menu", group_menu, markups.group_menu, ()),
+    ("reminder_menu", reminder_menu, markups.reminder_menu, (42,)),
+    ("task_actions_menu", task_actions_menu, markups.task_actions_menu, (42,)),
+    ("tasks_pagination_menu", tasks_pagination_menu, markups.tasks_pagination_menu, ([(1,), (2,)], 1, True, True)),
+    ("digest_menu", digest_menu, markups.digest_menu, ([1, 2, 3, 4, 5],)),
+]
+
+
+def payload(markup):
+    return markup.model_dump(exclude_none=True)
+
+
+def run(number):
+    print(f"{'markup':24s} {'builder':>12s} {'template':>12s}  speedup")
+    for name, old, new, args in CASES:
+        if payload(old(*args)) != payload(new(*args)):
+            raise SystemExit(f"{name}: template output differs from the builder")
+        old_time = timeit.timeit(lambda: old(*args), number=number) / number * 1e6
+        new_time = timeit.timeit(lambda: new(*args), number=number) / number * 1e6
+        print(f"{name:24s} {old_time:9.1f} us {new_time:9.1f} us  x{old_time / new_time:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare keyboard builders with markups.py templates")
+    parser.add_argument("--number", type=int, default=5000)
+    args = parser.parse_args()
+    run(args.number)
@@ -0,0 +1,196 @@
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.filters.callback_data import CallbackData
+import re
+
+
+class CreateTask(CallbackData, prefix="nt"):
+    pass
+
+
+class ListTasks(CallbackData, prefix="lt"):
+    pass
+
+
+class BackToList(CallbackData, prefix="bl"):
+    pass
+
+
+class DeleteAll(CallbackData, prefix="da"):
+    pass
+
+
+class ConfirmDeleteAll(CallbackData, prefix="dy"):
+    pass
+
+
+class MainMenu(CallbackData, prefix="mm"):
+    pass
+
+
+class GroupMenu(CallbackData, prefix="gm"):
+    pass
+
+
+class GroupSettings(CallbackData, prefix="gs"):
+    pass
+
+
+class ChangeTimezone(CallbackData, prefix="ctz"):
+    pass
+
+
+class Timezone(CallbackData, prefix="tz"):
+    choice: str
+
+
+class ConfirmDigest(CallbackData, prefix="dg"):
+    pass
+
+
+class TasksPage(CallbackData, prefix="p"):
+    page: int
+
+
+class ViewTask(CallbackData, prefix="v"):
+    task_id: int
+
+
+class EditTask(CallbackData, prefix="e"):
+    task_id: int
+
+
+class EditText(CallbackData, prefix="et"):
+    task_id: int
+
+
+class EditDate(CallbackData, prefix="ed"):
+    task_id: int
+
+
+class ConfirmEditText(CallbackData, prefix="ct"):
+    task_id: int
+
+
+class ConfirmEditDate(CallbackData, prefix="cd"):
+    task_id: int
+
+
+class ConfirmTask(CallbackData, prefix="c"):
+    task_id: int
+
+
+class SetReminder(CallbackData, prefix="r"):
+    task_id: int
+    minutes: int
+
+
+class AddReminder(CallbackData, prefix="ar"):
+    task_id: int
+
+
+class Reschedule(CallbackData, prefix="rs"):
+    task_id: int
+
+
+class DeleteTask(CallbackData, prefix="d"):
+    task_id: int
+
+
+class WithAssignee(CallbackData, prefix="aw"):
+    task_id: int
+
+
+class WithoutAssignee(CallbackData, prefix="an"):
+    task_id: int
+
+
+class ContinueAssignees(CallbackData, prefix="ac"):
+    task_id: int
+
+
+class AddAssignee(CallbackData, prefix="am"):
+    task_id: int
+
+
+def template(factory, **fixed):
+    # format string with the same layout as factory.pack(), free fields left as {placeholders}
+    parts = [factory.__prefix__]
+    for name in factory.model_fields:
+        parts.append(str(fixed[name]) if name in fixed else "{" + name + "}")
+    return factory.__separator__.join(parts)
+
+
+# buttons sent before the typed payloads, they stay in chats for a long time
+LEGACY_EXACT = {
+    "create_task": CreateTask,
+    "list_tasks": ListTasks,
+    "back_to_list": BackToList,
+    "delete_all": DeleteAll,
+    "confirm_delete_all": ConfirmDeleteAll,
+    "main_menu": MainMenu,
+    "group_menu": GroupMenu,
+    "group_settings": GroupSettings,
+    "change_timezone": ChangeTimezone,
+    "digest_confirm_all": ConfirmDigest,
+}
+
+LEGACY_PATTERNS = [
+    (re.compile(pattern), factory, fields) for pattern, factory, fields in (
+        (r"confirm_text_(\d+)", ConfirmEditText, ("task_id",)),
+        (r"confirm_date_(\d+)", ConfirmEditDate, ("task_id",)),
+        (r"confirm_(\d+)", ConfirmTask, ("task_id",)),
+        (r"edit_text_(\d+)", EditText, ("task_id",)),
+        (r"edit_date_(\d+)", EditDate, ("task_id",)),
+        (r"edit_(\d+)", EditTask, ("task_id",)),
+        (r"view_(\d+)", ViewTask, ("task_id",)),
+        (r"tasks_page_(\d+)", TasksPage, ("page",)),
+        (r"remind_(\d+)_(\d+)", SetReminder, ("minutes", "task_id")),
+        (r"reschedule_(\d+)", Reschedule, ("task_id",)),
+        (r"add_reminder_(\d+)", AddReminder, ("task_id",)),
+        (r"delete_(\d+)", DeleteTask, ("task_id",)),
+        (r"with_assignee_(\d+)", WithAssignee, ("task_id",)),
+        (r"without_assignee_(\d+)", WithoutAssignee, ("task_id",)),
+        (r"continue_(\d+)", ContinueAssignees, ("task_id",)),
+        (r"add_more_\d+_(\d+)", AddAssignee, ("task_id",)),
+        (r"tz_(\w+)", Timezone, ("choice",)),
+    )
+]
+
+
+def parse_legacy(data):
+    factory = LEGACY_EXACT.get(data)
+    if factory is not None:
+        return factory()
+    for pattern, factory, fields in LEGACY_PATTERNS:
+        match = pattern.fullmatch(data)
+        if match:
+            return factory(**dict(zip(fields, match.groups())))
+    return None
+
+
+class CallbackRouter:
+    def __init__(self):
+        self._routes = {}
+
+    def route(self, factory):
+        prefix = factory.__prefix__
+        if prefix in self._routes:
+            raise ValueError(f"Callback prefix {prefix!r} is already routed")
+
+        def decorator(handler):
+            self._routes[prefix] = (factory, CallableObject(handler))
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        route = self._routes.get(data.split(":", 1)[0])
+        if route is not None:
+            factory, handler = route
+            try:
+                return handler, factory.unpack(data)
+            except (TypeError, ValueError):
+                return None, None
+        callback_data = parse_legacy(data)
+        if callback_data is None or callback_data.__prefix__ not in self._routes:
+            return None, None
+        return self._routes[callback_data.__prefix__][1], callback_data
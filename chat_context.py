@@ -0,0 +1,60 @@
+from aiogram import BaseMiddleware
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from dp import get_chat_timezone, get_bot_rights, count_active_tasks, get_tasks_page
+
+current_chat_context = ContextVar("chat_context", default=None)
+
+
+class ChatContext:
+    def __init__(self, chat):
+        self.chat_id = chat.id
+        self.chat_type = chat.type
+        self.offset, self.timezone_name = get_chat_timezone(chat.id)
+        self._rights = None
+        self._active_count = None
+
+    @property
+    def is_private(self):
+        return self.chat_type == "private"
+
+    def local_now(self):
+        return datetime.utcnow() + timedelta(hours=self.offset)
+
+    def to_local(self, due_date):
+        if isinstance(due_date, str):
+            due_date = datetime.fromisoformat(due_date)
+        return due_date + timedelta(hours=self.offset)
+
+    def to_utc(self, local_date):
+        return local_date - timedelta(hours=self.offset)
+
+    async def rights(self):
+        if self._rights is None:
+            self._rights = await get_bot_rights(self.chat_id)
+        return self._rights
+
+    async def tasks_page(self, page=0):
+        # the page query counts the active tasks anyway, keep that count for active_count
+        tasks_page = await get_tasks_page(self.chat_id, page)
+        self._active_count = tasks_page.total
+        return tasks_page
+
+    async def active_count(self):
+        if self._active_count is None:
+            self._active_count = await count_active_tasks(self.chat_id)
+        return self._active_count
+
+
+class ChatContextMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is None:
+            return await handler(event, data)
+        chat_context = ChatContext(chat)
+        data["chat_context"] = chat_context
+        token = current_chat_context.set(chat_context)
+        try:
+            return await handler(event, data)
+        finally:
+            current_chat_context.reset(token)
@@ -1,2 +1,48 @@
 TOKEN = "YOUR TOKEN"
 DB_NAME = "database.db"
+DB_POOL_READERS = 4
+DB_POOL_TIMEOUT = 30
+SCHEDULER_RESYNC_INTERVAL = 300
+SCHEDULER_RETRY_DELAY = 30
+MAINTENANCE_INTERVAL = 3600
+MAINTENANCE_BATCH = 500
+MAINTENANCE_PAUSE = 0.1
+TASK_RETENTION = 86400
+TASKS_PER_PAGE = 2
+DELETE_MESSAGES_BATCH = 100
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_GROUP_RATE = 20
+OUTBOUND_GROUP_BURST = 10
+OUTBOUND_PRIVATE_RATE = 1
+OUTBOUND_MAX_RETRIES = 5
+EXPIRY_BATCH = 100
+BOT_RIGHTS_TTL = 600
+BOT_RIGHTS_ERROR_TTL = 5
+DELIVERY_MODE = "polling"
+WEBHOOK_URL = ""
+WEBHOOK_HOST = "127.0.0.1"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""
+FSM_CACHE_SIZE = 1000
+FSM_TTL = 86400
+FSM_FLUSH_INTERVAL = 2
+OUTBOX_BATCH = 20
+OUTBOX_RETRY_INTERVAL = 60
+OUTBOX_MAX_ATTEMPTS = 5
+CATCHUP_THRESHOLD = 900
+CATCHUP_MIN_EVENTS = 3
+CATCHUP_DIGEST_LIMIT = 30
+LEADER_LEASE_TTL = 15
+LEADER_HEARTBEAT = 5
+CHANGE_POLL_INTERVAL = 1
+CHANGE_LOG_BATCH = 1000
+CHANGE_LOG_RETENTION = 600
+SCHEDULER_SHARDS = 1
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+SLOW_UPDATE_THRESHOLD = 1.0
+UPDATE_STATS_WINDOW = 1000
+EXECUTOR_MAX_PENDING = 100
+EXECUTOR_CHAT_MAX_PENDING = 10
+EXECUTOR_CHAT_MAX_QUEUED = 100
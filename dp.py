@@ -1,31 +1,127 @@
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import TOKEN, DB_NAME
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.types import ChatMemberAdministrator, ChatMemberOwner
+from config import (
+    TOKEN, DB_NAME, DB_POOL_READERS, DB_POOL_TIMEOUT, TASKS_PER_PAGE,
+    DELETE_MESSAGES_BATCH, BOT_RIGHTS_TTL, BOT_RIGHTS_ERROR_TTL, OUTBOX_RETRY_INTERVAL, OUTBOX_MAX_ATTEMPTS
+)
+from executor import chat_executor
+from instrumentation import api_call_tracker, record_db, setup_instrumentation
+from outbound import outbound_limiter
+from scheduler import reminder_scheduler
+from storage import SQLiteStorage
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import NamedTuple
 import aiosqlite
 import asyncio
+import calendar
+import time
 
 bot = Bot(token=TOKEN)
-storage = MemoryStorage()
+bot.session.middleware(api_call_tracker)
+bot.session.middleware(outbound_limiter)
+
+class ConnectionPool:
+    def __init__(self, path, readers=DB_POOL_READERS, timeout=DB_POOL_TIMEOUT):
+        self.path = path
+        self.size = readers
+        self.timeout = timeout
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = asyncio.Queue()
+        self._all_readers = []
+
+    async def _connect(self, read_only=False):
+        conn = await aiosqlite.connect(self.path)
+        await conn.execute("PRAGMA journal_mode=WAL")
+        await conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+        await conn.execute("PRAGMA synchronous=NORMAL")
+        if read_only:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            conn = await self._connect(read_only=True)
+            self._all_readers.append(conn)
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def reader(self):
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self._readers.get(), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No free database reader after {self.timeout}s")
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+            record_db(time.perf_counter() - started)
+
+    @asynccontextmanager
+    async def writer(self):
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._write_lock.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Database writer busy for more than {self.timeout}s")
+        try:
+            yield self._writer
+        except BaseException:
+            await self._writer.rollback()
+            raise
+        finally:
+            self._write_lock.release()
+            record_db(time.perf_counter() - started)
+
+    async def close(self):
+        if self._writer is None:
+            return
+        async with self._write_lock:
+            for _ in self._all_readers:
+                await self._readers.get()
+            for conn in self._all_readers:
+                await conn.close()
+            await self._writer.close()
+            self._all_readers.clear()
+            self._writer = None
+
+
+db_pool = ConnectionPool(DB_NAME)
+storage = SQLiteStorage(db_pool)
 dp = Dispatcher(storage=storage)
-
-db_connection = None
-
-async def init_db():
-    global db_connection
-    db_connection = await aiosqlite.connect(DB_NAME)
-    await db_connection.execute("PRAGMA journal_mode=WAL")
-    await db_connection.execute("PRAGMA busy_timeout = 30000")
-
-    await db_connection.execute("""
+# the outer middlewares registered after it run inside the per-chat worker, the FSM and
+# user context ones run at submit time, so the worker re-reads the FSM state itself
+chat_executor.setup(dp)
+setup_instrumentation(dp)
+
+def _change_triggers(table, column, events=("INSERT", "UPDATE", "DELETE")):
+    return [
+        f"""
+        CREATE TRIGGER log_{table}_{event.lower()} AFTER {event} ON {table}
+        BEGIN
+            INSERT INTO data_changes (scope, key) VALUES ('{table}', {"OLD" if event == "DELETE" else "NEW"}.{column});
+        END
+        """
+        for event in events
+    ]
+
+MIGRATIONS = [
+    (
+        """
         CREATE TABLE IF NOT EXISTS group_timezones(
             chat_id INTEGER PRIMARY KEY,
             timezone TEXT,
             custom_name TEXT,
             custom_offset INTEGER
         )
-    """)
-
-    await db_connection.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS tasks(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
@@ -38,9 +134,8 @@ async def init_db():
             active BOOLEAN DEFAULT 1,
             main_notified BOOLEAN DEFAULT 0
         )
-    """)
-
-    await db_connection.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS bot_messages(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
@@ -48,38 +143,173 @@ async def init_db():
             task_id INTEGER,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-
-    await db_connection.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS pinned_messages(
             chat_id INTEGER,
             message_id INTEGER,
             task_id INTEGER,
             PRIMARY KEY (chat_id, task_id)
         )
-    """)
-
-    await db_connection.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS task_assignees(
             task_id INTEGER,
             assignee TEXT,
             PRIMARY KEY (task_id, assignee),
             FOREIGN KEY (task_id) REFERENCES tasks(id) ON DELETE CASCADE
         )
-    """)
+        """,
+    ),
+    (
+        "CREATE INDEX IF NOT EXISTS idx_tasks_chat_active_due ON tasks(chat_id, active, due_date)",
+        "CREATE INDEX IF NOT EXISTS idx_bot_messages_chat_task ON bot_messages(chat_id, task_id)",
+        "CREATE INDEX IF NOT EXISTS idx_bot_messages_chat_message ON bot_messages(chat_id, message_id)",
+    ),
+    (
+        "ALTER TABLE tasks ADD COLUMN due_epoch INTEGER",
+        "UPDATE tasks SET due_epoch = CAST(strftime('%s', due_date) AS INTEGER)",
+        """
+        ALTER TABLE tasks ADD COLUMN remind_epoch INTEGER GENERATED ALWAYS AS (
+            CASE WHEN reminder_minutes > 0 THEN due_epoch - reminder_minutes * 60 END
+        ) VIRTUAL
+        """,
+        "DROP INDEX IF EXISTS idx_tasks_chat_active_due",
+        "CREATE INDEX idx_tasks_chat_active_due_epoch ON tasks(chat_id, active, due_epoch)",
+        "CREATE INDEX idx_tasks_remind_pending ON tasks(remind_epoch) WHERE active=1 AND notified=0",
+        "CREATE INDEX idx_tasks_due_pending ON tasks(due_epoch) WHERE active=1 AND main_notified=0",
+        "CREATE INDEX idx_tasks_confirmed_due ON tasks(due_epoch) WHERE confirmed=1",
+    ),
+    (
+        """
+        CREATE TABLE message_expiry(
+            chat_id INTEGER,
+            message_id INTEGER,
+            expire_at INTEGER,
+            PRIMARY KEY (chat_id, message_id)
+        )
+        """,
+        "CREATE INDEX idx_message_expiry_expire_at ON message_expiry(expire_at)",
+    ),
+    (
+        """
+        CREATE TABLE fsm_storage(
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER
+        )
+        """,
+        "CREATE INDEX idx_fsm_storage_updated_at ON fsm_storage(updated_at)",
+    ),
+    (
+        """
+        CREATE TABLE reminder_outbox(
+            task_id INTEGER,
+            kind TEXT,
+            chat_id INTEGER,
+            fire_at INTEGER,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at INTEGER,
+            message_id INTEGER,
+            claimed_at INTEGER,
+            sent_at INTEGER,
+            PRIMARY KEY (task_id, kind)
+        )
+        """,
+        "CREATE INDEX idx_reminder_outbox_pending ON reminder_outbox(next_attempt_at) WHERE status='pending'",
+    ),
+    (
+        """
+        CREATE TABLE leases(
+            name TEXT PRIMARY KEY,
+            holder TEXT,
+            expires_at REAL
+        )
+        """,
+    ),
+    (
+        # lets other instances pick up exactly what changed instead of reloading everything
+        """
+        CREATE TABLE data_changes(
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            scope TEXT,
+            key,
+            changed_at INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER))
+        )
+        """,
+        "CREATE INDEX idx_data_changes_changed_at ON data_changes(changed_at)",
+        *_change_triggers("tasks", "id"),
+        *_change_triggers("group_timezones", "chat_id"),
+        *_change_triggers("message_expiry", "chat_id", ("INSERT", "UPDATE")),
+        *_change_triggers("fsm_storage", "key"),
+    ),
+]
+
+async def run_migrations(conn):
+    async with conn.execute("PRAGMA user_version") as cursor:
+        current = (await cursor.fetchone())[0]
+    for version, statements in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            for statement in statements:
+                if callable(statement):
+                    await statement(conn)
+                else:
+                    await conn.execute(statement)
+            await conn.execute(f"PRAGMA user_version = {version}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        print(f"Database migrated to version {version}")
 
-    await db_connection.commit()
+async def init_db():
+    await db_pool.open()
+    async with db_pool.writer() as conn:
+        await run_migrations(conn)
+    await load_chat_timezones()
 
 async def close_db():
-    global db_connection
-    if db_connection:
-        await db_connection.close()
+    await db_pool.close()
+
+TIMEZONES = {
+    'moscow': (3, 'Москва (UTC+3)'),
+    'ekb': (5, 'Екатеринбург (UTC+5)'),
+    'novosib': (7, 'Новосибирск (UTC+7)'),
+}
+DEFAULT_TIMEZONE = TIMEZONES['moscow']
+
+chat_timezones = {}
+
+def resolve_timezone(timezone, custom_name=None, custom_offset=None):
+    offset, name = TIMEZONES.get(timezone, DEFAULT_TIMEZONE)
+    if custom_offset is not None:
+        offset = custom_offset
+    if custom_name:
+        name = custom_name
+    return offset, name
+
+def get_chat_timezone(chat_id):
+    return chat_timezones.get(chat_id, DEFAULT_TIMEZONE)
+
+async def load_chat_timezones():
+    rows = await execute_fetchall(
+        "SELECT chat_id, timezone, custom_name, custom_offset FROM group_timezones"
+    )
+    chat_timezones.clear()
+    for chat_id, timezone, custom_name, custom_offset in rows:
+        chat_timezones[chat_id] = resolve_timezone(timezone, custom_name, custom_offset)
 
 async def set_group_timezone(chat_id, timezone, custom_name=None, custom_offset=None):
     await execute_query(
         "INSERT OR REPLACE INTO group_timezones (chat_id, timezone, custom_name, custom_offset) VALUES (?, ?, ?, ?)",
         (chat_id, timezone, custom_name, custom_offset)
     )
+    chat_timezones[chat_id] = resolve_timezone(timezone, custom_name, custom_offset)
 
 async def get_group_timezone(chat_id):
     return await execute_fetchone(
@@ -87,21 +317,59 @@ async def get_group_timezone(chat_id):
         (chat_id,)
     )
 
+def _placeholders(values):
+    return ", ".join("?" * len(values))
+
 async def execute_query(query, params=()):
-    async with aiosqlite.connect(DB_NAME) as conn:
+    async with db_pool.writer() as conn:
         cursor = await conn.execute(query, params)
         await conn.commit()
         return cursor
 
 async def execute_fetchone(query, params=()):
-    async with aiosqlite.connect(DB_NAME) as conn:
-        cursor = await conn.execute(query, params)
-        return await cursor.fetchone()
+    async with db_pool.reader() as conn:
+        async with conn.execute(query, params) as cursor:
+            return await cursor.fetchone()
 
 async def execute_fetchall(query, params=()):
-    async with aiosqlite.connect(DB_NAME) as conn:
-        cursor = await conn.execute(query, params)
-        return await cursor.fetchall()
+    async with db_pool.reader() as conn:
+        async with conn.execute(query, params) as cursor:
+            return await cursor.fetchall()
+
+async def get_data_version():
+    # only changes when another connection, i.e. another process, commits
+    async with db_pool.writer() as conn:
+        async with conn.execute("PRAGMA data_version") as cursor:
+            return (await cursor.fetchone())[0]
+
+async def get_last_change():
+    result = await execute_fetchone("SELECT MAX(seq) FROM data_changes")
+    return result[0] or 0
+
+async def get_changes(after, limit):
+    return await execute_fetchall(
+        "SELECT seq, scope, key FROM data_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+        (after, limit)
+    )
+
+async def purge_changes(before):
+    cursor = await execute_query("DELETE FROM data_changes WHERE changed_at < ?", (before,))
+    return cursor.rowcount
+
+async def acquire_lease(name, holder, ttl):
+    now = time.time()
+    cursor = await execute_query("""
+        INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at
+        WHERE leases.holder=excluded.holder OR leases.expires_at < ?
+    """, (name, holder, now + ttl, now))
+    return cursor.rowcount > 0
+
+async def release_lease(name, holder):
+    await execute_query(
+        "DELETE FROM leases WHERE name=? AND holder=?",
+        (name, holder)
+    )
 
 async def add_assignee(task_id, assignee):
     await execute_query(
@@ -116,6 +384,19 @@ async def get_assignees(task_id):
     )
     return [row[0] for row in rows]
 
+async def get_assignees_for(task_ids):
+    task_ids = [int(task_id) for task_id in task_ids]
+    assignees = {task_id: [] for task_id in task_ids}
+    if not task_ids:
+        return assignees
+    rows = await execute_fetchall(
+        f"SELECT task_id, assignee FROM task_assignees WHERE task_id IN ({_placeholders(task_ids)})",
+        task_ids
+    )
+    for task_id, assignee in rows:
+        assignees[task_id].append(assignee)
+    return assignees
+
 async def delete_assignees(task_id):
     await execute_query(
         "DELETE FROM task_assignees WHERE task_id=?",
@@ -141,11 +422,83 @@ async def delete_pinned_message(chat_id, task_id):
         (chat_id, task_id)
     )
 
+async def get_pinned_messages(chat_id):
+    return await execute_fetchall(
+        "SELECT task_id, message_id FROM pinned_messages WHERE chat_id=?",
+        (chat_id,)
+    )
+
+async def delete_pinned_messages(chat_id):
+    await execute_query(
+        "DELETE FROM pinned_messages WHERE chat_id=?",
+        (chat_id,)
+    )
+
+async def track_pinned_message(chat_id, message_id):
+    await execute_query("""
+        INSERT OR REPLACE INTO pinned_messages (chat_id, message_id, task_id)
+        SELECT chat_id, message_id, task_id FROM bot_messages
+        WHERE chat_id=? AND message_id=? AND task_id IS NOT NULL
+        LIMIT 1
+    """, (chat_id, message_id))
+
+async def pin_task_message(chat_id, message_id, task_id):
+    await bot.pin_chat_message(chat_id, message_id)
+    await add_pinned_message(chat_id, message_id, task_id)
+
+async def is_message_shared(chat_id, message_id, task_id):
+    result = await execute_fetchone(
+        "SELECT 1 FROM pinned_messages WHERE chat_id=? AND message_id=? AND task_id<>? LIMIT 1",
+        (chat_id, message_id, task_id)
+    )
+    return result is not None
+
+async def unpin_task_message(chat_id, task_id, delete=False):
+    message_id = await get_pinned_message(chat_id, task_id)
+    if not message_id:
+        return None
+    # a catch-up digest stays pinned until its last task is gone
+    if await is_message_shared(chat_id, message_id, task_id):
+        await delete_pinned_message(chat_id, task_id)
+        return None
+    try:
+        if delete:
+            # deleting a pinned message unpins it as well
+            await bot.delete_message(chat_id, message_id)
+        else:
+            await bot.unpin_chat_message(chat_id, message_id)
+    except TelegramAPIError as e:
+        print(f"Error removing pinned message {message_id} in chat {chat_id}: {e}")
+        if delete:
+            try:
+                await bot.unpin_chat_message(chat_id, message_id)
+            except TelegramAPIError:
+                pass
+    await delete_pinned_message(chat_id, task_id)
+    return message_id
+
+async def unpin_chat_task_messages(chat_id):
+    rows = await get_pinned_messages(chat_id)
+    message_ids = sorted({message_id for _, message_id in rows})
+    results = await asyncio.gather(
+        *(bot.unpin_chat_message(chat_id, message_id) for message_id in message_ids),
+        return_exceptions=True
+    )
+    for message_id, result in zip(message_ids, results):
+        if isinstance(result, Exception):
+            print(f"Error unpinning message {message_id} in chat {chat_id}: {result}")
+    await delete_pinned_messages(chat_id)
+    return len(message_ids)
+
+def to_epoch(due_date):
+    return calendar.timegm(datetime.fromisoformat(due_date).timetuple())
+
 async def add_task(chat_id, user_id, text, due_date, reminder_minutes=None):
     cursor = await execute_query(
-        "INSERT INTO tasks (chat_id, user_id, text, due_date, reminder_minutes) VALUES (?, ?, ?, ?, ?)",
-        (chat_id, user_id, text, due_date, reminder_minutes)
+        "INSERT INTO tasks (chat_id, user_id, text, due_date, due_epoch, reminder_minutes) VALUES (?, ?, ?, ?, ?, ?)",
+        (chat_id, user_id, text, due_date, to_epoch(due_date), reminder_minutes)
     )
+    reminder_scheduler.notify(cursor.lastrowid)
     return cursor.lastrowid
 
 async def get_task(task_id):
@@ -155,22 +508,91 @@ async def get_task(task_id):
     )
 
 async def is_message_pinned(chat_id, message_id):
+    result = await execute_fetchone(
+        "SELECT 1 FROM pinned_messages WHERE chat_id=? AND message_id=?",
+        (chat_id, message_id)
+    )
+    return result is not None
+
+class BotRights(NamedTuple):
+    is_admin: bool
+    can_delete_messages: bool
+    can_pin_messages: bool
+
+NO_RIGHTS = BotRights(False, False, False)
+
+bot_rights = {}
+
+def rights_from_member(member):
+    if isinstance(member, ChatMemberOwner):
+        return BotRights(True, True, True)
+    if isinstance(member, ChatMemberAdministrator):
+        return BotRights(True, bool(member.can_delete_messages), bool(member.can_pin_messages))
+    return NO_RIGHTS
+
+def set_bot_rights(chat_id, member):
+    bot_rights[chat_id] = (time.monotonic() + BOT_RIGHTS_TTL, rights_from_member(member))
+
+async def get_bot_rights(chat_id):
+    cached = bot_rights.get(chat_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    ttl = BOT_RIGHTS_TTL
     try:
-        chat = await bot.get_chat(chat_id)
-        if chat.pinned_message and chat.pinned_message.message_id == message_id:
-            return True
-        return False
-    except Exception as e:
-        print(f"Error checking pinned message: {e}")
-        return False
+        rights = rights_from_member(await bot.get_chat_member(chat_id, bot.id))
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        print(f"Error checking bot rights in chat {chat_id}: {e}")
+        rights = NO_RIGHTS
+    except TelegramAPIError as e:
+        # network errors, 5xx and flood waits say nothing about the rights, retry soon
+        print(f"Error checking bot rights in chat {chat_id}: {e}")
+        rights = NO_RIGHTS
+        ttl = BOT_RIGHTS_ERROR_TTL
+    bot_rights[chat_id] = (time.monotonic() + ttl, rights)
+    return rights
 
 async def get_all_tasks(chat_id):
     return await execute_fetchall("""
         SELECT id, text, due_date, reminder_minutes
         FROM tasks
-        WHERE chat_id=? AND active=1 AND datetime(due_date) > datetime('now', '-1 day')
-        ORDER BY datetime(due_date) ASC
-    """, (chat_id,))
+        WHERE chat_id=? AND active=1 AND due_epoch > ?
+        ORDER BY due_epoch ASC
+    """, (chat_id, int(time.time()) - 86400))
+
+class TasksPage(NamedTuple):
+    tasks: list
+    page: int
+    pages: int
+    total: int
+    has_prev: bool
+    has_next: bool
+
+async def count_active_tasks(chat_id):
+    result = await execute_fetchone(
+        "SELECT COUNT(*) FROM tasks WHERE chat_id=? AND active=1 AND due_epoch > ?",
+        (chat_id, int(time.time()) - 86400)
+    )
+    return result[0]
+
+async def get_tasks_page(chat_id, page=0, per_page=TASKS_PER_PAGE):
+    since = int(time.time()) - 86400
+    async with db_pool.reader() as conn:
+        async with conn.execute(
+            "SELECT COUNT(*) FROM tasks WHERE chat_id=? AND active=1 AND due_epoch > ?",
+            (chat_id, since)
+        ) as cursor:
+            total = (await cursor.fetchone())[0]
+        pages = max(1, (total + per_page - 1) // per_page)
+        page = min(max(page, 0), pages - 1)
+        async with conn.execute("""
+            SELECT id, text, due_date, reminder_minutes
+            FROM tasks
+            WHERE chat_id=? AND active=1 AND due_epoch > ?
+            ORDER BY due_epoch ASC, id ASC
+            LIMIT ? OFFSET ?
+        """, (chat_id, since, per_page, page * per_page)) as cursor:
+            tasks = await cursor.fetchall()
+    return TasksPage(tasks, page, pages, total, page > 0, page < pages - 1)
 
 async def update_task(task_id, text=None, due_date=None, reminder_minutes=None,
                       notified=None, confirmed=None, active=None, main_notified=None):
@@ -181,8 +603,8 @@ async def update_task(task_id, text=None, due_date=None, reminder_minutes=None,
         updates.append("text=?")
         params.append(text)
     if due_date is not None:
-        updates.append("due_date=?")
-        params.append(due_date)
+        updates.append("due_date=?, due_epoch=?")
+        params.extend((due_date, to_epoch(due_date)))
     if reminder_minutes is not None:
         updates.append("reminder_minutes=?")
         params.append(reminder_minutes)
@@ -201,7 +623,204 @@ async def update_task(task_id, text=None, due_date=None, reminder_minutes=None,
 
     params.append(task_id)
     query = f"UPDATE tasks SET {', '.join(updates)} WHERE id=?"
-    await execute_query(query, params)
+    reset_kinds = [
+        kind for kind, flag in (('reminder', notified), ('due', main_notified))
+        if flag is not None and not flag
+    ]
+    async with db_pool.writer() as conn:
+        await conn.execute(query, params)
+        if reset_kinds:
+            await conn.execute(
+                f"DELETE FROM reminder_outbox WHERE task_id=? AND kind IN ({_placeholders(reset_kinds)})",
+                [task_id] + reset_kinds
+            )
+        await conn.commit()
+    if any(value is not None for value in (due_date, reminder_minutes, notified, active, main_notified)):
+        reminder_scheduler.notify(task_id)
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+ALL_SHARDS = Shard(0, 1)
+
+def _shard_filter(shard, column="chat_id"):
+    if shard.count <= 1:
+        return "", []
+    return f" AND abs({column}) % ? = ?", [shard.count, shard.index]
+
+async def get_pending_events(task_ids=None, shard=ALL_SHARDS):
+    query = """
+        SELECT id, remind_epoch, 'reminder' FROM tasks
+        WHERE active=1 AND notified=0 AND remind_epoch IS NOT NULL{filter}
+        UNION ALL
+        SELECT id, due_epoch, 'due' FROM tasks
+        WHERE active=1 AND main_notified=0{filter}
+    """
+    condition, params = _shard_filter(shard)
+    if task_ids is not None:
+        if not task_ids:
+            return []
+        task_ids = list(task_ids)
+        condition += f" AND id IN ({_placeholders(task_ids)})"
+        params += task_ids
+    return await execute_fetchall(query.format(filter=condition), params + params)
+
+OUTBOX_KINDS = (
+    ('reminder', 'notified', 'remind_epoch'),
+    ('due', 'main_notified', 'due_epoch'),
+)
+
+async def claim_due_reminders(task_ids, now):
+    task_ids = [int(task_id) for task_id in task_ids]
+    if not task_ids:
+        return 0
+    id_filter = _placeholders(task_ids)
+    claimed = 0
+    async with db_pool.writer() as conn:
+        for kind, flag, fire_column in OUTBOX_KINDS:
+            condition = f"id IN ({id_filter}) AND active=1 AND {flag}=0 AND {fire_column} <= ?"
+            cursor = await conn.execute(f"""
+                INSERT OR IGNORE INTO reminder_outbox
+                    (task_id, kind, chat_id, fire_at, claimed_at, next_attempt_at)
+                SELECT id, ?, chat_id, {fire_column}, ?, ? FROM tasks WHERE {condition}
+            """, [kind, now, now] + task_ids + [now])
+            claimed += cursor.rowcount
+            await conn.execute(
+                f"UPDATE tasks SET {flag}=1 WHERE {condition}",
+                task_ids + [now]
+            )
+        await conn.commit()
+    return claimed
+
+async def get_outbox_chats(now, shard=ALL_SHARDS):
+    condition, params = _shard_filter(shard)
+    rows = await execute_fetchall(f"""
+        SELECT DISTINCT chat_id FROM reminder_outbox
+        WHERE status='pending' AND next_attempt_at <= ?{condition}
+    """, [now] + params)
+    return [row[0] for row in rows]
+
+async def get_pending_outbox(chat_id, now, limit):
+    return await execute_fetchall("""
+        SELECT o.task_id, o.kind, o.chat_id, o.fire_at, t.text, t.due_date, t.reminder_minutes
+        FROM reminder_outbox o
+        JOIN tasks t ON t.id = o.task_id
+        WHERE o.chat_id=? AND o.status='pending' AND o.next_attempt_at <= ?
+        ORDER BY o.next_attempt_at
+        LIMIT ?
+    """, (chat_id, now, limit))
+
+async def get_catchup_chats(now, threshold, min_events, shard=ALL_SHARDS):
+    condition, params = _shard_filter(shard)
+    rows = await execute_fetchall(f"""
+        SELECT chat_id FROM reminder_outbox
+        WHERE status='pending' AND next_attempt_at <= ? AND fire_at < ?{condition}
+        GROUP BY chat_id
+        HAVING COUNT(*) > ?
+    """, [now, now - threshold] + params + [min_events])
+    return [row[0] for row in rows]
+
+async def get_catchup_outbox(chat_id, now, threshold, limit):
+    return await execute_fetchall("""
+        SELECT o.task_id, o.kind, o.chat_id, o.fire_at, t.text, t.due_date, t.reminder_minutes
+        FROM reminder_outbox o
+        JOIN tasks t ON t.id = o.task_id
+        WHERE o.chat_id=? AND o.status='pending' AND o.next_attempt_at <= ? AND o.fire_at < ?
+        ORDER BY t.due_epoch, o.task_id
+        LIMIT ?
+    """, (chat_id, now, now - threshold, limit))
+
+async def ack_digest(chat_id, entries, message_id, pinned, now):
+    task_ids = sorted({task_id for task_id, _ in entries})
+    async with db_pool.writer() as conn:
+        await conn.executemany(
+            "UPDATE reminder_outbox SET status='sent', message_id=?, sent_at=? WHERE task_id=? AND kind=?",
+            [(message_id, now, task_id, kind) for task_id, kind in entries]
+        )
+        # not tied to a task, so confirming one task doesn't delete the whole digest
+        await conn.execute(
+            "INSERT INTO bot_messages (chat_id, message_id, task_id) VALUES (?, ?, NULL)",
+            (chat_id, message_id)
+        )
+        if pinned:
+            await conn.executemany(
+                "INSERT OR REPLACE INTO pinned_messages (chat_id, message_id, task_id) VALUES (?, ?, ?)",
+                [(chat_id, message_id, task_id) for task_id in task_ids]
+            )
+        await conn.commit()
+
+async def get_digest_tasks(chat_id, message_id):
+    rows = await execute_fetchall(
+        "SELECT DISTINCT task_id FROM reminder_outbox WHERE chat_id=? AND message_id=? AND status='sent'",
+        (chat_id, message_id)
+    )
+    return [row[0] for row in rows]
+
+async def ack_outbox(sent, failed, now):
+    async with db_pool.writer() as conn:
+        await conn.executemany(
+            "UPDATE reminder_outbox SET status='sent', message_id=?, sent_at=? WHERE task_id=? AND kind=?",
+            [(message_id, now, task_id, kind) for task_id, kind, _, message_id, _ in sent]
+        )
+        await conn.executemany(
+            "INSERT INTO bot_messages (chat_id, message_id, task_id) VALUES (?, ?, ?)",
+            [(chat_id, message_id, task_id) for task_id, _, chat_id, message_id, _ in sent]
+        )
+        await conn.executemany(
+            "INSERT OR REPLACE INTO pinned_messages (chat_id, message_id, task_id) VALUES (?, ?, ?)",
+            [(chat_id, message_id, task_id) for task_id, _, chat_id, message_id, pinned in sent if pinned]
+        )
+        await conn.executemany("""
+            UPDATE reminder_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = ? + ? * (attempts + 1),
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END
+            WHERE task_id=? AND kind=?
+        """, [(now, OUTBOX_RETRY_INTERVAL, OUTBOX_MAX_ATTEMPTS, task_id, kind) for task_id, kind in failed])
+        await conn.commit()
+
+# bot_messages is the only record of messages still in the chat, purge_orphan_messages
+# deletes those from the chat before dropping the rows
+TASK_DEPENDENTS = ("task_assignees", "pinned_messages", "reminder_outbox")
+
+async def purge_expired_tasks(before, limit):
+    removed = dict.fromkeys(("tasks",) + TASK_DEPENDENTS, 0)
+    async with db_pool.writer() as conn:
+        async with conn.execute(
+            "SELECT id FROM tasks WHERE confirmed=1 AND due_epoch < ? LIMIT ?",
+            (before, limit)
+        ) as cursor:
+            task_ids = [row[0] for row in await cursor.fetchall()]
+        if not task_ids:
+            return removed
+        id_filter = _placeholders(task_ids)
+        for table in TASK_DEPENDENTS:
+            cursor = await conn.execute(f"DELETE FROM {table} WHERE task_id IN ({id_filter})", task_ids)
+            removed[table] = cursor.rowcount
+        cursor = await conn.execute(f"DELETE FROM tasks WHERE id IN ({id_filter})", task_ids)
+        removed["tasks"] = cursor.rowcount
+        await conn.commit()
+    return removed
+
+async def purge_orphans(table, limit):
+    cursor = await execute_query(f"""
+        DELETE FROM {table} WHERE rowid IN (
+            SELECT d.rowid FROM {table} d
+            LEFT JOIN tasks t ON t.id = d.task_id
+            WHERE d.task_id IS NOT NULL AND t.id IS NULL
+            LIMIT ?
+        )
+    """, (limit,))
+    return cursor.rowcount
+
+async def get_orphan_bot_messages(limit):
+    return await execute_fetchall("""
+        SELECT d.chat_id, d.message_id FROM bot_messages d
+        LEFT JOIN tasks t ON t.id = d.task_id
+        WHERE d.task_id IS NOT NULL AND t.id IS NULL
+        LIMIT ?
+    """, (limit,))
 
 async def delete_task(task_id):
     await execute_query(
@@ -239,3 +858,59 @@ async def delete_bot_message(chat_id, message_id):
         "DELETE FROM bot_messages WHERE chat_id=? AND message_id=?",
         (chat_id, message_id)
     )
+
+async def delete_bot_messages(chat_id, message_ids):
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    await execute_query(
+        f"DELETE FROM bot_messages WHERE chat_id=? AND message_id IN ({_placeholders(message_ids)})",
+        [chat_id] + message_ids
+    )
+
+async def delete_chat_messages(chat_id, message_ids):
+    failed = {}
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+        batch = message_ids[start:start + DELETE_MESSAGES_BATCH]
+        try:
+            await bot.delete_messages(chat_id, batch)
+            continue
+        except TelegramRetryAfter as e:
+            failed.update((message_id, e) for message_id in batch)
+            continue
+        except TelegramAPIError:
+            pass
+        for message_id in batch:
+            try:
+                await bot.delete_message(chat_id, message_id)
+            except TelegramAPIError as e:
+                failed[message_id] = e
+    for message_id, error in failed.items():
+        print(f"Error deleting message {message_id} in chat {chat_id}: {error}")
+    return failed
+
+async def add_message_expiry(chat_id, message_id, expire_at):
+    await execute_query(
+        "INSERT OR REPLACE INTO message_expiry (chat_id, message_id, expire_at) VALUES (?, ?, ?)",
+        (chat_id, message_id, expire_at)
+    )
+
+async def get_due_expiries(now, limit):
+    return await execute_fetchall(
+        "SELECT chat_id, message_id FROM message_expiry WHERE expire_at <= ? ORDER BY expire_at LIMIT ?",
+        (now, limit)
+    )
+
+async def get_next_expiry():
+    result = await execute_fetchone("SELECT MIN(expire_at) FROM message_expiry")
+    return result[0] if result else None
+
+async def delete_message_expiries(chat_id, message_ids):
+    message_ids = list(message_ids)
+    if not message_ids:
+        return
+    await execute_query(
+        f"DELETE FROM message_expiry WHERE chat_id=? AND message_id IN ({_placeholders(message_ids)})",
+        [chat_id] + message_ids
+    )
@@ -0,0 +1,120 @@
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.dispatcher.event.handler import HandlerObject
+from aiogram.loggers import event as event_logger
+from aiogram.types.error_event import ErrorEvent
+from collections import deque
+from config import EXECUTOR_MAX_PENDING, EXECUTOR_CHAT_MAX_PENDING, EXECUTOR_CHAT_MAX_QUEUED
+import asyncio
+
+
+class ChatExecutor(BaseMiddleware):
+    def __init__(self, max_pending=EXECUTOR_MAX_PENDING, chat_max_pending=EXECUTOR_CHAT_MAX_PENDING,
+                 chat_max_queued=EXECUTOR_CHAT_MAX_QUEUED):
+        self.max_pending = max_pending
+        self.chat_max_pending = chat_max_pending
+        self.chat_max_queued = chat_max_queued
+        self.dispatcher = None
+        self._slots = asyncio.Semaphore(max_pending)
+        self._queues = {}
+        self._held = {}
+        self._overflow = {}
+        self._workers = {}
+
+    def setup(self, dispatcher):
+        self.dispatcher = dispatcher
+        dispatcher.update.outer_middleware(self)
+        # drain before fsm.close flushes the storage and the bot session is closed
+        dispatcher.shutdown.handlers.insert(0, HandlerObject(callback=self.close))
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        user = data.get("event_from_user")
+        key = chat.id if chat is not None else (user.id if user is not None else None)
+        callback = event.callback_query
+        if not await self.submit(key, lambda: self._run(handler, event, data), droppable=callback is not None):
+            print(f"Dropped callback query in chat {key}: too many pending updates")
+            try:
+                await data["bot"].answer_callback_query(callback.id, text="⏳ Слишком много запросов, попробуйте позже")
+            except Exception as e:
+                print(f"Error answering dropped callback query in chat {key}: {e}")
+            return UNHANDLED
+
+    async def _run(self, handler, event, data):
+        try:
+            # FSMContextMiddleware resolved raw_state when the update was queued, an earlier
+            # update of this chat may have changed it since
+            state = data.get("state")
+            if state is not None:
+                data["raw_state"] = await state.get_state()
+            await handler(event, data)
+        except Exception as e:
+            # ErrorsMiddleware has already returned by now, hand the error to dp.errors ourselves
+            try:
+                if self.dispatcher is not None:
+                    response = await self.dispatcher.propagate_event(
+                        update_type="error", event=ErrorEvent(update=event, exception=e), **data
+                    )
+                    if response is not UNHANDLED:
+                        return
+                raise
+            except Exception as error:
+                event_logger.exception(
+                    "Cause exception while process update id=%d by bot id=%d\n%s: %s",
+                    event.update_id, data["bot"].id, error.__class__.__name__, error
+                )
+
+    async def submit(self, key, job, droppable=False):
+        slot = False
+        if self._held.get(key, 0) < self.chat_max_pending:
+            # blocks the feeder once max_pending updates are queued or running
+            await self._slots.acquire()
+            if self._held.get(key, 0) < self.chat_max_pending:
+                self._held[key] = self._held.get(key, 0) + 1
+                slot = True
+            else:
+                self._slots.release()
+        if not slot:
+            # a busy chat queues the rest without slots so it cannot stall the other chats
+            if droppable and self._overflow.get(key, 0) >= self.chat_max_queued:
+                return False
+            self._overflow[key] = self._overflow.get(key, 0) + 1
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append((job, slot))
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._work(key, queue))
+        return True
+
+    def _done(self, key, slot):
+        counts = self._held if slot else self._overflow
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
+        if slot:
+            self._slots.release()
+
+    async def _work(self, key, queue):
+        try:
+            while queue:
+                job, slot = queue.popleft()
+                try:
+                    await job()
+                except Exception:
+                    event_logger.exception("Unhandled error in update job for chat %s", key)
+                finally:
+                    self._done(key, slot)
+        finally:
+            # a cancelled worker must still give back what its queued jobs hold
+            while queue:
+                self._done(key, queue.popleft()[1])
+            self._queues.pop(key, None)
+            self._workers.pop(key, None)
+
+    async def close(self):
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+
+chat_executor = ChatExecutor()
@@ -0,0 +1,57 @@
+from config import EXPIRY_BATCH
+from dp import (
+    add_message_expiry, get_due_expiries, get_next_expiry, delete_message_expiries,
+    delete_chat_messages, delete_bot_messages
+)
+import asyncio
+import time
+
+
+class MessageExpiry:
+    def __init__(self, batch_size=EXPIRY_BATCH):
+        self.batch_size = batch_size
+        self._next_at = None
+        self._wakeup = asyncio.Event()
+
+    async def schedule(self, chat_id, message_id, delay):
+        expire_at = int(time.time() + delay)
+        await add_message_expiry(chat_id, message_id, expire_at)
+        if self._next_at is None or expire_at < self._next_at:
+            self._next_at = expire_at
+            self._wakeup.set()
+
+    def wake(self):
+        self._wakeup.set()
+
+    async def expire_due(self, now):
+        rows = await get_due_expiries(now, self.batch_size)
+        by_chat = {}
+        for chat_id, message_id in rows:
+            by_chat.setdefault(chat_id, []).append(message_id)
+        for chat_id, message_ids in by_chat.items():
+            failed = await delete_chat_messages(chat_id, message_ids)
+            await delete_bot_messages(chat_id, [m for m in message_ids if m not in failed])
+            await delete_message_expiries(chat_id, message_ids)
+        return len(rows)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            now = int(time.time())
+            try:
+                if await self.expire_due(now) >= self.batch_size:
+                    continue
+                self._next_at = await get_next_expiry()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Message expiry error: {e}")
+                self._next_at = now + 30
+            timeout = None if self._next_at is None else max(0, self._next_at - time.time())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+message_expiry = MessageExpiry()
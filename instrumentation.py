@@ -0,0 +1,101 @@
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from config import SLOW_UPDATE_THRESHOLD, UPDATE_STATS_WINDOW
+from contextvars import ContextVar
+from metrics import metrics
+import time
+
+update_seconds = metrics.summary(
+    "update_seconds", "End to end update handling time", labels=("handler",), window=UPDATE_STATS_WINDOW
+)
+update_db_round_trips = metrics.counter(
+    "update_db_round_trips_total", "Database connection checkouts made while handling updates", labels=("handler",)
+)
+update_api_calls = metrics.counter(
+    "update_api_calls_total", "Bot API calls made while handling updates", labels=("handler",)
+)
+
+current_stats = ContextVar("update_stats", default=None)
+
+
+class UpdateStats:
+    __slots__ = ("handler", "db_calls", "db_time", "api_calls", "api_time", "done")
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.db_calls = 0
+        self.db_time = 0.0
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.done = False
+
+
+def record_db(elapsed):
+    stats = current_stats.get()
+    # tasks spawned during an update inherit its context, ignore them once it is over
+    if stats is not None and not stats.done:
+        stats.db_calls += 1
+        stats.db_time += elapsed
+
+
+class UpdateInstrumentation(BaseMiddleware):
+    def __init__(self, slow_threshold=SLOW_UPDATE_THRESHOLD):
+        self.slow_threshold = slow_threshold
+
+    async def __call__(self, handler, event, data):
+        stats = UpdateStats()
+        token = current_stats.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.done = True
+            current_stats.reset(token)
+            update_seconds.observe(elapsed, handler=stats.handler)
+            update_db_round_trips.inc(stats.db_calls, handler=stats.handler)
+            update_api_calls.inc(stats.api_calls, handler=stats.handler)
+            if elapsed >= self.slow_threshold:
+                p = update_seconds.percentiles(handler=stats.handler)
+                print(
+                    f"Slow update {event.update_id} in {stats.handler}: {elapsed:.3f}s, "
+                    f"db {stats.db_calls} round trips {stats.db_time:.3f}s, "
+                    f"api {stats.api_calls} calls {stats.api_time:.3f}s, "
+                    f"p50/p95/p99 {p[0.5]:.3f}/{p[0.95]:.3f}/{p[0.99]:.3f}s"
+                )
+
+
+def set_handler_name(name):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.handler = name
+
+
+class HandlerTracker(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        set_handler_name(data["handler"].callback.__name__)
+        return await handler(event, data)
+
+
+class ApiCallTracker(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        stats = current_stats.get()
+        if stats is None or stats.done:
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            stats.api_calls += 1
+            stats.api_time += time.perf_counter() - started
+
+
+def setup_instrumentation(dispatcher):
+    dispatcher.update.outer_middleware(UpdateInstrumentation())
+    handler_tracker = HandlerTracker()
+    for name, observer in dispatcher.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(handler_tracker)
+
+
+api_call_tracker = ApiCallTracker()
@@ -0,0 +1,69 @@
+from config import LEADER_LEASE_TTL, LEADER_HEARTBEAT
+from dp import acquire_lease, release_lease
+import asyncio
+import os
+import socket
+import time
+import uuid
+
+
+class LeaderLease:
+    def __init__(self, name="leader", ttl=LEADER_LEASE_TTL, heartbeat=LEADER_HEARTBEAT):
+        self.name = name
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.valid_until = 0
+
+    @property
+    def is_leader(self):
+        return time.time() < self.valid_until
+
+    async def renew(self):
+        started = time.time()
+        try:
+            if await acquire_lease(self.name, self.holder, self.ttl):
+                # step down one heartbeat early so two leaders never overlap
+                self.valid_until = started + self.ttl - self.heartbeat
+        except Exception as e:
+            print(f"Error renewing lease {self.name}: {e}")
+
+    async def run(self, job):
+        task = None
+        try:
+            while True:
+                await self.renew()
+                if task is not None and task.done():
+                    if not task.cancelled() and task.exception():
+                        print(f"Leader job crashed: {task.exception()}")
+                    task = None
+                if self.is_leader and task is None:
+                    print(f"Lease {self.name} acquired by {self.holder}")
+                    task = asyncio.create_task(job())
+                elif not self.is_leader and task is not None:
+                    print(f"Lease {self.name} lost by {self.holder}")
+                    await stop(task)
+                    task = None
+                await asyncio.sleep(self.heartbeat)
+        finally:
+            if task is not None:
+                await stop(task)
+            if self.is_leader:
+                self.valid_until = 0
+                try:
+                    await release_lease(self.name, self.holder)
+                except Exception:
+                    pass
+
+
+async def stop(task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        pass
+
+
+leader_lease = LeaderLease()
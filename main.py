@@ -5,22 +5,42 @@ from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime, timedelta
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dp import (
-    dp, bot, add_task, get_task, get_all_tasks, update_task, delete_task, 
-    delete_all_tasks, add_pinned_message, get_pinned_message, delete_pinned_message,
-    add_assignee, get_assignees, delete_assignees, add_bot_message, 
-    get_bot_messages, delete_bot_message,
-    init_db, close_db
+    dp, bot, add_task, get_task, update_task, delete_task, 
+    delete_all_tasks,
+    add_assignee, get_assignees, get_assignees_for, delete_assignees, add_bot_message, 
+    get_bot_messages, delete_bot_message, delete_bot_messages, delete_chat_messages, get_pending_events,
+    get_bot_rights, set_bot_rights, claim_due_reminders,
+    get_outbox_chats, get_pending_outbox, ack_outbox, ALL_SHARDS, get_catchup_chats, get_catchup_outbox, ack_digest, get_digest_tasks,
+    unpin_task_message, unpin_chat_task_messages, track_pinned_message, init_db, close_db,
+    get_data_version, get_last_change, get_changes, load_chat_timezones, storage
 )
 from typing import Union
-from dp import add_bot_message, get_bot_messages, delete_bot_message, get_group_timezone, set_group_timezone, is_message_pinned
+from dp import add_bot_message, get_bot_messages, delete_bot_message, get_chat_timezone, set_group_timezone, is_message_pinned, TIMEZONES
 from markups import group_menu, reminder_menu, task_actions_menu, confirmation_menu, private_menu, timezone_menu, timezone_confirmation_menu, cancel_timezone_menu
+from functools import partial
 import asyncio
 import sqlite3
-from config import DB_NAME
+import time
 import markups as mk
-import aiosqlite
+import callbacks as cb
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from config import (
+    OUTBOX_BATCH, OUTBOX_RETRY_INTERVAL, CATCHUP_THRESHOLD, CATCHUP_MIN_EVENTS,
+    CATCHUP_DIGEST_LIMIT, CHANGE_POLL_INTERVAL, CHANGE_LOG_BATCH, SCHEDULER_SHARDS, METRICS_PORT, DELIVERY_MODE, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_PATH, WEBHOOK_SECRET
+)
+from expiry import message_expiry
+from executor import chat_executor
+from leader import leader_lease
+from maintenance import maintenance
+from metrics import metrics, serve_metrics
+from scheduler import reminder_scheduler
+from instrumentation import set_handler_name
+from chat_context import ChatContext, ChatContextMiddleware, current_chat_context
 
 router = Router()
+callback_router = cb.CallbackRouter()
 
 class TaskStates(StatesGroup):
     waiting_for_task = State()
@@ -83,13 +103,10 @@ async def cleanup_bot_messages(chat_id: int, task_id=None):
     if not await bot_has_permissions(chat_id):
         return
     message_ids = await get_bot_messages(chat_id, task_id)
-    for message_id in message_ids:
-        try:
-            await bot.delete_message(chat_id, message_id)
-            await delete_bot_message(chat_id, message_id)
-            await asyncio.sleep(0.3)
-        except:
-            continue
+    if not message_ids:
+        return
+    failed = await delete_chat_messages(chat_id, message_ids)
+    await delete_bot_messages(chat_id, [m for m in message_ids if m not in failed])
 
 async def cleanup_user_message(chat_id: int, message_id: int):
     try:
@@ -121,12 +138,7 @@ async def send_and_track_message(chat_id, text, reply_markup=None, task_id=None,
             except:
                 await asyncio.sleep(0.1 * (attempt + 1))
         if delete_after:
-            await asyncio.sleep(delete_after)
-            try:
-                await msg.delete()
-                await delete_bot_message(chat_id, msg.message_id)
-            except:
-                pass
+            await message_expiry.schedule(chat_id, msg.message_id, delete_after)
         return msg
     except:
         return None
@@ -191,36 +203,44 @@ async def cleanup_all_start_messages(chat_id: int):
         for message in messages:
             try:
                 await bot.delete_message(chat_id, message.message_id)
-                await asyncio.sleep(0.3)
             except:
                 continue
     except:
         raise
 
 async def bot_has_permissions(chat_id: int) -> bool:
-    try:
-        chat_member = await bot.get_chat_member(chat_id, bot.id)
-        return chat_member.can_delete_messages
-    except:
-        return False
+    chat_context = current_chat_context.get()
+    if chat_context is not None and chat_context.chat_id == chat_id:
+        rights = await chat_context.rights()
+    else:
+        rights = await get_bot_rights(chat_id)
+    return rights.can_delete_messages
 
-@router.callback_query(F.data == "group_settings")
+@router.my_chat_member()
+async def bot_member_updated_handler(event: types.ChatMemberUpdated):
+    set_bot_rights(event.chat.id, event.new_chat_member)
+
+@router.message(F.pinned_message)
+async def pinned_message_handler(message: types.Message):
+    await track_pinned_message(message.chat.id, message.pinned_message.message_id)
+
+@callback_router.route(cb.GroupSettings)
 async def group_settings_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "⚙️ Настройки группы",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="group_menu")]
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=cb.GroupMenu().pack())]
         ])
     )
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_list")
-async def back_to_list_handler(callback: types.CallbackQuery):
-    tasks = await get_all_tasks(callback.message.chat.id)
-    if tasks:
+@callback_router.route(cb.BackToList)
+async def back_to_list_handler(callback: types.CallbackQuery, chat_context: ChatContext):
+    tasks_page = await chat_context.tasks_page()
+    if tasks_page.total:
         await send_tasks_page(
-            chat_id=callback.message.chat.id,
-            tasks=tasks,
+            chat_context,
+            tasks_page=tasks_page,
             edit_message_id=callback.message.message_id
         )
     else:
@@ -230,7 +250,7 @@ async def back_to_list_handler(callback: types.CallbackQuery):
         )
     await callback.answer()
 
-@router.callback_query(F.data == "main_menu")
+@callback_router.route(cb.MainMenu)
 async def main_menu_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "📋 Главное меню",
@@ -238,11 +258,10 @@ async def main_menu_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("remind_"))
-async def set_reminder_handler(callback: types.CallbackQuery):
+@callback_router.route(cb.SetReminder)
+async def set_reminder_handler(callback: types.CallbackQuery, callback_data: cb.SetReminder):
     await cleanup_bot_messages(callback.message.chat.id)
-    _, minutes, task_id = callback.data.split('_')
-    minutes = int(minutes)
+    task_id, minutes = callback_data.task_id, callback_data.minutes
     await update_task(task_id, reminder_minutes=minutes)
     if minutes > 0:
         hours = minutes // 60
@@ -262,11 +281,11 @@ async def set_reminder_handler(callback: types.CallbackQuery):
             delete_after=3
         )
 
-@router.callback_query(F.data == "list_tasks")
-async def list_tasks_handler(callback: types.CallbackQuery):
+@callback_router.route(cb.ListTasks)
+async def list_tasks_handler(callback: types.CallbackQuery, chat_context: ChatContext):
     try:
-        tasks = await get_all_tasks(callback.message.chat.id)
-        if not tasks:
+        tasks_page = await chat_context.tasks_page()
+        if not tasks_page.total:
             await callback.message.edit_text(
                 "📭 Нет активных задач",
                 reply_markup=mk.group_menu(),
@@ -274,40 +293,21 @@ async def list_tasks_handler(callback: types.CallbackQuery):
             )
             return
         await send_tasks_page(
-            chat_id=callback.message.chat.id,
-            tasks=tasks,
+            chat_context,
+            tasks_page=tasks_page,
             edit_message_id=callback.message.message_id
         )
     except:
         await callback.answer("Сталася помилка, спробуйте ще раз")
 
-async def send_tasks_page(chat_id, tasks, page=0, edit_message_id=None):
-    tz_info = await get_group_timezone(chat_id)
-    if not tz_info:
-        tz_offset = 5
-        tz_name = "Екатеринбург (UTC+5)"
-    else:
-        tz_offset = tz_info[2] if tz_info[2] is not None else {
-            'moscow': 3,
-            'ekb': 5,
-            'novosib': 7
-        }.get(tz_info[0], 5)
-        tz_name = tz_info[1] if tz_info[1] else {
-            'moscow': 'Москва (UTC+3)',
-            'ekb': 'Екатеринбург (UTC+5)',
-            'novosib': 'Новосибирск (UTC+7)'
-        }.get(tz_info[0], 'Екатеринбург (UTC+5)')
-
-    now_utc = datetime.utcnow()
-    local_now = now_utc + timedelta(hours=tz_offset)
+async def send_tasks_page(chat_context, tasks_page, edit_message_id=None):
+    chat_id = chat_context.chat_id
+    tz_name = chat_context.timezone_name
+    local_now = chat_context.local_now()
     current_date_str = local_now.strftime('%d.%m.%Y %H:%M')
 
-    tasks_per_page = 2
-    total_tasks = len(tasks)
-    page = min(page, max(0, (total_tasks + tasks_per_page - 1) // tasks_per_page - 1))
-    start_idx = page * tasks_per_page
-    end_idx = (page + 1) * tasks_per_page
-    current_tasks = tasks[start_idx:end_idx]
+    current_tasks = tasks_page.tasks
+    assignees_by_task = await get_assignees_for(task[0] for task in current_tasks)
 
     message_text = f"<b>🕒 Часовой пояс:</b> {escape_html(tz_name)} ({current_date_str})\n\n"
     message_text += f"<b>📅 Список задач</b>\n\n"
@@ -322,8 +322,7 @@ async def send_tasks_page(chat_id, tasks, page=0, edit_message_id=None):
             task_id, text, due_date, reminder = task
 
         try:
-            due_datetime = datetime.fromisoformat(due_date)
-            local_due_datetime = due_datetime + timedelta(hours=tz_offset)
+            local_due_datetime = chat_context.to_local(due_date)
             due_date_str = local_due_datetime.strftime('%d.%m.%Y %H:%M')
 
             if local_due_datetime < local_now:
@@ -339,7 +338,7 @@ async def send_tasks_page(chat_id, tasks, page=0, edit_message_id=None):
                 mins = reminder % 60
                 reminder_text = f"\n⏰ Напоминание: за {hours} ч {mins} мин" if hours else f"\n⏰ Напоминание: за {mins} мин"
 
-            assignees = await get_assignees(task_id)
+            assignees = assignees_by_task[task_id]
             assignees_without_at = [a[1:] if a.startswith('@') else a for a in assignees]
 
             safe_text = escape_html(text)
@@ -354,10 +353,11 @@ async def send_tasks_page(chat_id, tasks, page=0, edit_message_id=None):
         except:
             continue
 
-    message_text += f"<b>Страница {page+1} из {max(1, (total_tasks + tasks_per_page - 1) // tasks_per_page)}</b>"
+    message_text += f"<b>Страница {tasks_page.page + 1} из {tasks_page.pages}</b>"
 
-    keyboard = mk.tasks_pagination_menu(tasks, page, tasks_per_page)
-    keyboard.inline_keyboard.append([InlineKeyboardButton(text="🕒 Сменить часовой пояс", callback_data="change_timezone")])
+    keyboard = mk.tasks_pagination_menu(
+        current_tasks, tasks_page.page, tasks_page.has_prev, tasks_page.has_next, timezone_row=True
+    )
 
     try:
         if edit_message_id:
@@ -382,17 +382,17 @@ async def send_tasks_page(chat_id, tasks, page=0, edit_message_id=None):
         pass
 
 
-@router.callback_query(F.data.startswith("edit_"))
-async def edit_task_handler(callback: types.CallbackQuery):
-    task_id = callback.data.split("_")[1]
+@callback_router.route(cb.EditTask)
+async def edit_task_handler(callback: types.CallbackQuery, callback_data: cb.EditTask):
+    task_id = callback_data.task_id
     await callback.message.edit_text(
         "Что вы хотите изменить?",
-        reply_markup=edit_options_menu(task_id)
+        reply_markup=mk.edit_options_menu(task_id)
     )
 
-@router.callback_query(F.data.startswith("edit_text_"))
-async def edit_text_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.EditText)
+async def edit_text_handler(callback: types.CallbackQuery, callback_data: cb.EditText, state: FSMContext):
+    task_id = callback_data.task_id
     task = await get_task(task_id)
     if not task:
         await callback.answer("Задача не найдена")
@@ -408,7 +408,7 @@ async def edit_text_handler(callback: types.CallbackQuery, state: FSMContext):
     )
     await state.set_state(TaskStates.waiting_for_edit_text)
 
-@router.callback_query(F.data == "group_menu")
+@callback_router.route(cb.GroupMenu)
 async def main_menu_handler(callback: types.CallbackQuery):
     try:
         await callback.message.delete()
@@ -422,45 +422,33 @@ async def main_menu_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(lambda c: c.data and c.data.startswith("edit_date_"))
-async def edit_date_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.EditDate)
+async def edit_date_handler(callback: types.CallbackQuery, callback_data: cb.EditDate, state: FSMContext, chat_context: ChatContext):
+    task_id = callback_data.task_id
     task = await get_task(task_id)
     if not task:
         await callback.answer("Задача не найдена")
         return
-    tz_info = await get_group_timezone(callback.message.chat.id)
-    if tz_info:
-        timezone, custom_name, custom_offset = tz_info
-        tz_offset = custom_offset if custom_offset is not None else {
-            'moscow': 3,
-            'ekb': 5,
-            'novosib': 7
-        }.get(timezone, 3)
-    else:
-        tz_offset = 3
     _, _, _, _, due_date, _, *_ = task
-    due_datetime = datetime.fromisoformat(due_date)
-    local_due_datetime = due_datetime + timedelta(hours=tz_offset)
-    current_date = local_due_datetime.strftime('%d.%m.%Y %H:%M')
+    current_date = chat_context.to_local(due_date).strftime('%d.%m.%Y %H:%M')
     await state.update_data({
         'task_id': task_id,
         'current_date': current_date,
         'edit_message_id': callback.message.message_id,
-        'tz_offset': tz_offset
+        'tz_offset': chat_context.offset
     })
     await callback.message.delete()
     await send_and_track_message(
         callback.message.chat.id,
         f"📅 Введите новую дату в формате ДД.ММ.ГГГГ ЧЧ:ММ\n\nТекущая дата: {current_date}",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data=f"edit_{task_id}")]
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=cb.EditTask(task_id=task_id).pack())]
         ]),
         task_id=task_id
     )
     await state.set_state(TaskStates.waiting_for_edit_date)
 
-@router.callback_query(F.data == "create_task")
+@callback_router.route(cb.CreateTask)
 async def create_task_handler(callback: types.CallbackQuery, state: FSMContext):
     try:
         await cleanup_user_and_bot_messages(callback.message.chat.id, callback.message.message_id)
@@ -476,7 +464,7 @@ async def create_task_handler(callback: types.CallbackQuery, state: FSMContext):
 
 
 @router.message(TaskStates.waiting_for_task)
-async def process_task(message: types.Message, state: FSMContext):
+async def process_task(message: types.Message, state: FSMContext, chat_context: ChatContext):
     user_message_id = message.message_id
     chat_id = message.chat.id
 
@@ -494,19 +482,12 @@ async def process_task(message: types.Message, state: FSMContext):
                 "❌ Неверный формат. Введите через запятую:\n"
                 "Например: Парикмахер, 10.07.2025 13:26",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="↩️ Попробовать снова", callback_data="create_task")]
+                    [InlineKeyboardButton(text="↩️ Попробовать снова", callback_data=cb.CreateTask().pack())]
                 ])
             )
             await state.update_data(error_message_id=error_msg.message_id)
             return
 
-        tz_info = await get_group_timezone(chat_id)
-        tz_offset = 3
-        if tz_info:
-            timezone, custom_name, custom_offset = tz_info
-            if custom_offset is not None:
-                tz_offset = custom_offset
-
         try:
             date_part, time_part = date.split()
 
@@ -538,7 +519,7 @@ async def process_task(message: types.Message, state: FSMContext):
                 int(year), int(month), int(day),
                 int(hour), int(minute))
 
-            utc_due_date = local_due_date - timedelta(hours=tz_offset)
+            utc_due_date = chat_context.to_utc(local_due_date)
 
             if utc_due_date < datetime.utcnow():
                 raise ValueError("Дата не может быть в прошлом")
@@ -579,7 +560,7 @@ async def process_task(message: types.Message, state: FSMContext):
                 "\n".join(examples) +
                 "\n\nПопробуйте еще раз:",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="↩️ Ввести заново", callback_data="create_task")]
+                    [InlineKeyboardButton(text="↩️ Ввести заново", callback_data=cb.CreateTask().pack())]
                 ])
             )
             await state.update_data(error_message_id=error_msg.message_id)
@@ -591,14 +572,14 @@ async def process_task(message: types.Message, state: FSMContext):
             chat_id,
             "❌ Произошла ошибка. Попробуйте еще раз",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="↩️ Ввести заново", callback_data="create_task")]
+                [InlineKeyboardButton(text="↩️ Ввести заново", callback_data=cb.CreateTask().pack())]
             ]),
             delete_after=10
         )
 
-@router.callback_query(F.data.startswith("with_assignee_"))
-async def with_assignee_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.WithAssignee)
+async def with_assignee_handler(callback: types.CallbackQuery, callback_data: cb.WithAssignee, state: FSMContext):
+    task_id = callback_data.task_id
     await state.update_data({'task_id': task_id})
     await cleanup_bot_messages(callback.message.chat.id)
     await send_and_track_message(
@@ -608,9 +589,9 @@ async def with_assignee_handler(callback: types.CallbackQuery, state: FSMContext
     )
     await state.set_state(TaskStates.waiting_for_assignee)
 
-@router.callback_query(F.data.startswith("without_assignee_"))
-async def without_assignee_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.WithoutAssignee)
+async def without_assignee_handler(callback: types.CallbackQuery, callback_data: cb.WithoutAssignee, state: FSMContext):
+    task_id = callback_data.task_id
     await cleanup_bot_messages(callback.message.chat.id)
     await send_and_track_message(
         callback.message.chat.id,
@@ -651,9 +632,9 @@ async def process_assignee(message: types.Message, state: FSMContext):
             delete_after=5
         )
 
-@router.callback_query(F.data.startswith("continue_"))
-async def continue_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[1]
+@callback_router.route(cb.ContinueAssignees)
+async def continue_handler(callback: types.CallbackQuery, callback_data: cb.ContinueAssignees, state: FSMContext):
+    task_id = callback_data.task_id
     await cleanup_bot_messages(callback.message.chat.id)
     await send_and_track_message(
         callback.message.chat.id,
@@ -663,9 +644,9 @@ async def continue_handler(callback: types.CallbackQuery, state: FSMContext):
     )
     await state.clear()
 
-@router.callback_query(F.data.startswith("add_more_"))
-async def add_more_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.AddAssignee)
+async def add_more_handler(callback: types.CallbackQuery, callback_data: cb.AddAssignee, state: FSMContext):
+    task_id = callback_data.task_id
     await state.set_state(TaskStates.waiting_for_assignee)
     await cleanup_bot_messages(callback.message.chat.id)
     await send_and_track_message(
@@ -681,7 +662,7 @@ def get_current_time_str(offset_hours):
     return local_time.strftime("%H:%M")
 
 # Добавляем обработчики
-@router.callback_query(F.data == "change_timezone")
+@callback_router.route(cb.ChangeTimezone)
 async def change_timezone_handler(callback: types.CallbackQuery):
     # Получаем текущее время для Екатеринбурга (UTC+5)
     ekb_time = get_current_time_str(5)
@@ -692,31 +673,18 @@ async def change_timezone_handler(callback: types.CallbackQuery):
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("tz_"))
-async def timezone_selection_handler(callback: types.CallbackQuery, state: FSMContext):
-    tz_data = callback.data.split("_")[1]
+@callback_router.route(cb.Timezone)
+async def timezone_selection_handler(callback: types.CallbackQuery, callback_data: cb.Timezone, state: FSMContext):
+    tz_data = callback_data.choice
     
-    if tz_data == "moscow":
-        await state.update_data({
-            'timezone': 'moscow',
-            'offset': 3,
-            'name': 'Москва (UTC+3)'
-        })
-        time_str = get_current_time_str(3)
-    elif tz_data == "ekb":
+    if tz_data in TIMEZONES:
+        offset, name = TIMEZONES[tz_data]
         await state.update_data({
-            'timezone': 'ekb',
-            'offset': 5,
-            'name': 'Екатеринбург (UTC+5)'
+            'timezone': tz_data,
+            'offset': offset,
+            'name': name
         })
-        time_str = get_current_time_str(5)
-    elif tz_data == "novosib":
-        await state.update_data({
-            'timezone': 'novosib',
-            'offset': 7,
-            'name': 'Новосибирск (UTC+7)'
-        })
-        time_str = get_current_time_str(7)
+        time_str = get_current_time_str(offset)
     elif tz_data == "custom":
         await callback.message.delete()  # Удаляем предыдущее сообщение
         await send_and_track_message(
@@ -870,28 +838,22 @@ async def process_custom_hours(message: types.Message, state: FSMContext):
     )
     await state.set_state(TimezoneStates.waiting_for_confirmation)
 
-@router.callback_query(F.data.startswith("reschedule_"))
-async def reschedule_task_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[1]
+@callback_router.route(cb.Reschedule)
+async def reschedule_task_handler(callback: types.CallbackQuery, callback_data: cb.Reschedule, state: FSMContext, chat_context: ChatContext):
+    task_id = callback_data.task_id
     task = await get_task(task_id)
     if not task:
         await callback.answer("Задача не найдена")
         return
 
-    tz_info = await get_group_timezone(callback.message.chat.id)
-    tz_offset = tz_info[2] if tz_info and tz_info[2] is not None else {
-        'moscow': 3, 'ekb': 5, 'novosib': 7
-    }.get(tz_info[0], 3) if tz_info else 3
-
     _, _, _, text, due_date, *_ = task
-    local_due = datetime.fromisoformat(due_date) + timedelta(hours=tz_offset)
-    current_date = local_due.strftime('%d.%m.%Y %H:%M')
+    current_date = chat_context.to_local(due_date).strftime('%d.%m.%Y %H:%M')
 
     await state.update_data({
         'task_id': task_id,
         'current_text': text,
         'current_date': current_date,
-        'tz_offset': tz_offset
+        'tz_offset': chat_context.offset
     })
 
     await callback.message.delete()
@@ -900,7 +862,7 @@ async def reschedule_task_handler(callback: types.CallbackQuery, state: FSMConte
         f"🔄 Перенос задачи:\n\n📌 {text}\nТекущая дата: {current_date}\n\n"
         "Введите новую дату в формате ДД.ММ.ГГГГ ЧЧ:ММ\nНапример: 25.07.2025 15:30",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отменить", callback_data=f"view_{task_id}")]
+            [InlineKeyboardButton(text="❌ Отменить", callback_data=cb.ViewTask(task_id=task_id).pack())]
         ]),
         task_id=task_id
     )
@@ -976,7 +938,7 @@ async def process_new_date(message: types.Message, state: FSMContext):
                 f"❌ Ошибка: {str(e)}\n\nПравильные форматы даты:\n" +
                 "\n".join(examples) + "\n\nПопробуйте еще раз:",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="❌ Отменить", callback_data=f"view_{task_id}")]
+                    [InlineKeyboardButton(text="❌ Отменить", callback_data=cb.ViewTask(task_id=task_id).pack())]
                 ]),
                 task_id=task_id
             )
@@ -986,15 +948,15 @@ async def process_new_date(message: types.Message, state: FSMContext):
             message.chat.id,
             "❌ Произошла ошибка. Попробуйте еще раз",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="❌ Отменить", callback_data=f"view_{task_id}")]
+                [InlineKeyboardButton(text="❌ Отменить", callback_data=cb.ViewTask(task_id=task_id).pack())]
             ]),
             task_id=task_id,
             delete_after=5
         )
 
-@router.callback_query(F.data.startswith("add_reminder_"))
-async def add_reminder_handler(callback: types.CallbackQuery):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.AddReminder)
+async def add_reminder_handler(callback: types.CallbackQuery, callback_data: cb.AddReminder):
+    task_id = callback_data.task_id
     await cleanup_bot_messages(callback.message.chat.id)
     await send_and_track_message(
         callback.message.chat.id,
@@ -1003,39 +965,37 @@ async def add_reminder_handler(callback: types.CallbackQuery):
         task_id=task_id
     )
 
-@router.callback_query(F.data == "delete_all")
+@callback_router.route(cb.DeleteAll)
 async def delete_all_handler(callback: types.CallbackQuery):
     await callback.message.edit_text(
         "⚠️ Вы уверены, что хотите удалить ВСЕ задачи?",
         reply_markup=mk.delete_all_confirmation()
     )
 
-@router.callback_query(F.data == "confirm_delete_all")
+@callback_router.route(cb.ConfirmDeleteAll)
 async def confirm_delete_all_handler(callback: types.CallbackQuery):
+    await unpin_chat_task_messages(callback.message.chat.id)
     await delete_all_tasks(callback.message.chat.id)
     await callback.message.edit_text(
         "✅ Все задачи удалены",
         reply_markup=mk.group_menu()
     )
 
-@router.callback_query(F.data.startswith("delete_"))
-async def delete_task_handler(callback: types.CallbackQuery):
-    task_id = callback.data.split("_")[1]
+@callback_router.route(cb.DeleteTask)
+async def delete_task_handler(callback: types.CallbackQuery, callback_data: cb.DeleteTask, chat_context: ChatContext):
+    task_id = callback_data.task_id
     try:
-        pinned_msg_id = await get_pinned_message(callback.message.chat.id, task_id)
-        if pinned_msg_id:
-            await bot.unpin_chat_message(callback.message.chat.id, pinned_msg_id)
-            await delete_pinned_message(callback.message.chat.id, task_id)
+        await unpin_task_message(callback.message.chat.id, task_id)
     except:
         pass
 
     await delete_task(task_id)
-    tasks = await get_all_tasks(callback.message.chat.id)
+    tasks_page = await chat_context.tasks_page()
     
-    if tasks:
+    if tasks_page.total:
         await send_tasks_page(
-            chat_id=callback.message.chat.id,
-            tasks=tasks,
+            chat_context,
+            tasks_page=tasks_page,
             edit_message_id=callback.message.message_id
         )
     else:
@@ -1044,34 +1004,27 @@ async def delete_task_handler(callback: types.CallbackQuery):
             reply_markup=mk.group_menu()
         )
 
-@router.callback_query(F.data.startswith("tasks_page_"))
-async def tasks_page_handler(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
-    tasks = await get_all_tasks(callback.message.chat.id)
+@callback_router.route(cb.TasksPage)
+async def tasks_page_handler(callback: types.CallbackQuery, callback_data: cb.TasksPage, chat_context: ChatContext):
+    page = callback_data.page
+    tasks_page = await chat_context.tasks_page(page)
     await send_tasks_page(
-        chat_id=callback.message.chat.id,
-        tasks=tasks,
-        page=page,
+        chat_context,
+        tasks_page=tasks_page,
         edit_message_id=callback.message.message_id
     )
     await callback.answer()
 
-@router.callback_query(F.data.startswith("view_"))
-async def view_task_handler(callback: types.CallbackQuery):
-    task_id = callback.data.split("_")[1]
+@callback_router.route(cb.ViewTask)
+async def view_task_handler(callback: types.CallbackQuery, callback_data: cb.ViewTask, chat_context: ChatContext):
+    task_id = callback_data.task_id
     task = await get_task(task_id)
     if not task:
         await callback.answer("Задача не найдена")
         return
 
-    tz_info = await get_group_timezone(callback.message.chat.id)
-    tz_offset = tz_info[2] if tz_info and tz_info[2] is not None else {
-        'moscow': 3, 'ekb': 5, 'novosib': 7
-    }.get(tz_info[0], 3) if tz_info else 3
-
     _, _, _, text, due_date, reminder, *_ = task
-    local_due = datetime.fromisoformat(due_date) + timedelta(hours=tz_offset)
-    due_date_str = local_due.strftime('%d.%m.%Y %H:%M')
+    due_date_str = chat_context.to_local(due_date).strftime('%d.%m.%Y %H:%M')
 
     reminder_text = ""
     if reminder and reminder > 0:
@@ -1091,22 +1044,56 @@ async def view_task_handler(callback: types.CallbackQuery):
         parse_mode="HTML"
     )
 
-@router.callback_query(F.data.startswith("confirm_"))
-async def confirm_task_handler(callback: types.CallbackQuery):
-    task_id = callback.data.split('_')[1]
+@callback_router.route(cb.ConfirmTask)
+async def confirm_task_handler(callback: types.CallbackQuery, callback_data: cb.ConfirmTask):
+    task_id = callback_data.task_id
 
-    pinned_msg_id = await get_pinned_message(callback.message.chat.id, task_id)
-    if pinned_msg_id:
-        chat = await bot.get_chat(callback.message.chat.id)
-        if chat.pinned_message and chat.pinned_message.message_id == pinned_msg_id:
-            await bot.unpin_chat_message(callback.message.chat.id)
-        await bot.delete_message(callback.message.chat.id, pinned_msg_id)
-        await delete_pinned_message(callback.message.chat.id, task_id)
+    removed = await unpin_task_message(callback.message.chat.id, task_id, delete=True)
 
     await update_task(task_id, confirmed=1)
     await cleanup_bot_messages(callback.message.chat.id, task_id)
+    if removed is None and is_digest_message(callback.message):
+        await drop_digest_button(callback.message, callback.data)
     await callback.answer("✅ Задача подтверждена", show_alert=False)
 
+# digests sent before the typed payloads still carry the legacy string
+DIGEST_CONFIRM_ALL = {cb.ConfirmDigest().pack(), "digest_confirm_all"}
+
+def is_digest_message(message):
+    markup = message.reply_markup
+    return markup is not None and any(
+        button.callback_data in DIGEST_CONFIRM_ALL
+        for row in markup.inline_keyboard for button in row
+    )
+
+async def drop_digest_button(message, callback_data):
+    rows = [
+        [button for button in row if button.callback_data != callback_data]
+        for row in message.reply_markup.inline_keyboard
+    ]
+    rows = [row for row in rows if row]
+    try:
+        if len(rows) == 1:
+            await message.delete()
+        else:
+            await message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    except Exception as e:
+        print(f"Error updating digest {message.message_id} in chat {message.chat.id}: {e}")
+
+@callback_router.route(cb.ConfirmDigest)
+async def confirm_digest_handler(callback: types.CallbackQuery):
+    chat_id = callback.message.chat.id
+    task_ids = await get_digest_tasks(chat_id, callback.message.message_id)
+    for task_id in task_ids:
+        await unpin_task_message(chat_id, task_id, delete=True)
+        await update_task(task_id, confirmed=1)
+        await cleanup_bot_messages(chat_id, task_id)
+    try:
+        await callback.message.delete()
+    except Exception:
+        pass
+    await callback.answer(f"✅ Подтверждено задач: {len(task_ids)}", show_alert=False)
+
 @router.message(TaskStates.waiting_for_edit_text)
 async def process_edit_text(message: types.Message, state: FSMContext):
     data = await state.get_data()
@@ -1138,15 +1125,15 @@ async def process_edit_text(message: types.Message, state: FSMContext):
         message.chat.id,
         f"Вы ввели новый текст:\n{new_text}\n\nПодтвердить изменения?",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Да", callback_data=f"confirm_text_{task_id}"),
-             InlineKeyboardButton(text="❌ Нет", callback_data=f"edit_{task_id}")]
+            [InlineKeyboardButton(text="✅ Да", callback_data=cb.ConfirmEditText(task_id=task_id).pack()),
+             InlineKeyboardButton(text="❌ Нет", callback_data=cb.EditTask(task_id=task_id).pack())]
         ]),
         task_id=task_id
     )
 
-@router.callback_query(F.data.startswith("confirm_text_"))
-async def confirm_edit_text_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.ConfirmEditText)
+async def confirm_edit_text_handler(callback: types.CallbackQuery, callback_data: cb.ConfirmEditText, state: FSMContext):
+    task_id = callback_data.task_id
     data = await state.get_data()
     new_text = data['new_text']
 
@@ -1201,15 +1188,15 @@ async def process_edit_date(message: types.Message, state: FSMContext):
         message.chat.id,
         f"Вы ввели новую дату:\n{new_date_str}\n\nПодтвердить изменения?",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Да", callback_data=f"confirm_date_{task_id}"),
-             InlineKeyboardButton(text="❌ Нет", callback_data=f"edit_{task_id}")]
+            [InlineKeyboardButton(text="✅ Да", callback_data=cb.ConfirmEditDate(task_id=task_id).pack()),
+             InlineKeyboardButton(text="❌ Нет", callback_data=cb.EditTask(task_id=task_id).pack())]
         ]),
         task_id=task_id
     )
 
-@router.callback_query(F.data.startswith("confirm_date_"))
-async def confirm_edit_date_handler(callback: types.CallbackQuery, state: FSMContext):
-    task_id = callback.data.split("_")[2]
+@callback_router.route(cb.ConfirmEditDate)
+async def confirm_edit_date_handler(callback: types.CallbackQuery, callback_data: cb.ConfirmEditDate, state: FSMContext):
+    task_id = callback_data.task_id
     data = await state.get_data()
     new_date = data['new_date']
 
@@ -1245,117 +1232,286 @@ async def confirm_edit_date_handler(callback: types.CallbackQuery, state: FSMCon
 
     await state.clear()
 
-async def check_reminders():
-    while True:
-        now_utc = datetime.utcnow()
-
-        async with aiosqlite.connect(DB_NAME) as conn:
-            await conn.execute("""
-                DELETE FROM tasks 
-                WHERE confirmed=1 AND datetime(due_date) < datetime('now', '-1 day')
-            """)
-            await conn.commit()
-
-            cursor = await conn.execute("""
-                SELECT t.id, t.chat_id, t.text, t.due_date, t.reminder_minutes, 
-                       t.notified, t.confirmed, t.main_notified, t.active,
-                       g.timezone, g.custom_offset
-                FROM tasks t
-                LEFT JOIN group_timezones g ON t.chat_id = g.chat_id
-                WHERE t.active=1
-            """)
-            tasks = await cursor.fetchall()
-
-        for task in tasks:
-            task_id = task[0]
-            chat_id = task[1]
-            text = task[2]
-            due_date = task[3]
-            reminder_minutes = task[4]
-            notified = task[5]
-            confirmed = task[6]
-            main_notified = task[7]
-            active = task[8]
-            timezone = task[9] if task[9] else 'moscow'
-            custom_offset = task[10] if task[10] is not None else None
+chat_senders = {}
+chat_rerun = set()
+
+reminder_lag = metrics.histogram(
+    "reminder_lag_seconds", "Delay between a reminder's fire time and its delivery", labels=("kind",)
+)
+reminder_sends = metrics.counter(
+    "reminder_sends_total", "Reminder messages sent", labels=("chat_id", "kind")
+)
+reminder_failures = metrics.counter(
+    "reminder_send_failures_total", "Reminder messages that failed to send", labels=("chat_id", "kind")
+)
 
+def render_reminder(task_id, kind, chat_id, text, due_date, reminder_minutes, assignees):
+    due_datetime = datetime.fromisoformat(due_date.replace(' ', 'T', 1))
+    offset, _ = get_chat_timezone(chat_id)
+    local_due_datetime = due_datetime + timedelta(hours=offset)
+
+    assignees_text = ' '.join(escape_html(a) for a in assignees) if assignees else "Нет"
+    safe_text = escape_html(text)
+    formatted_date = escape_html(local_due_datetime.strftime('%d.%m.%Y %H:%M'))
+
+    if kind == 'reminder':
+        return (
+            f"⏰ <b>Напоминание за {reminder_minutes} мин</b>\n"
+            f"📌 <b>Задача:</b> {safe_text}\n"
+            f"🕒 <b>Время:</b> {formatted_date}\n"
+            f"👥 <b>Исполнители:</b> {assignees_text}"
+        ), mk.confirmation_menu(task_id, reminder=True)
+    return (
+        f"🔔 <b>Время выполнять!</b>\n"
+        f"📌 <b>Задача:</b> {safe_text}\n"
+        f"🕒 <b>Назначенное время:</b> {formatted_date}\n"
+        f"👥 <b>Исполнители:</b> {assignees_text}"
+    ), mk.confirmation_menu(task_id, due=True)
+
+async def send_outbox_entry(task_id, kind, chat_id, text, due_date, reminder_minutes, assignees):
+    message_text, markup = render_reminder(
+        task_id, kind, chat_id, text, due_date, reminder_minutes, assignees
+    )
+    if kind == 'reminder':
+        await cleanup_bot_messages(chat_id, task_id)
+    msg = await bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode="HTML")
+    pinned = False
+    if kind == 'due' and (await get_bot_rights(chat_id)).can_pin_messages:
+        try:
+            await bot.pin_chat_message(chat_id, msg.message_id)
+            pinned = True
+        except Exception:
+            pass
+    return msg.message_id, pinned
+
+def render_digest(chat_id, entries, assignees_by_task):
+    offset, _ = get_chat_timezone(chat_id)
+    tasks = {}
+    for task_id, kind, _, _, text, due_date, _ in entries:
+        task = tasks.setdefault(task_id, [text, due_date, set()])
+        task[2].add(kind)
+
+    lines = [f"📬 <b>Пропущенные напоминания: {len(tasks)}</b>", ""]
+    for task_id, (text, due_date, kinds) in tasks.items():
+        due_datetime = datetime.fromisoformat(due_date.replace(' ', 'T', 1)) + timedelta(hours=offset)
+        icon = "🔔" if 'due' in kinds else "⏰"
+        line = f"{icon} #{task_id} {escape_html(text)} — {due_datetime.strftime('%d.%m.%Y %H:%M')}"
+        assignees = assignees_by_task[task_id]
+        if assignees:
+            line += f"\n      👥 {' '.join(escape_html(a) for a in assignees)}"
+        lines.append(line)
+    return "\n".join(lines), mk.digest_menu(list(tasks))
+
+async def send_catchup_digest(chat_id, now):
+    while True:
+        entries = await get_catchup_outbox(chat_id, now, CATCHUP_THRESHOLD, CATCHUP_DIGEST_LIMIT)
+        if not entries:
+            return
+        keys = [(entry[0], entry[1]) for entry in entries]
+        try:
+            assignees_by_task = await get_assignees_for({entry[0] for entry in entries})
+            message_text, markup = render_digest(chat_id, entries, assignees_by_task)
+            msg = await bot.send_message(chat_id, message_text, reply_markup=markup, parse_mode="HTML")
+        except Exception as e:
+            print(f"Error sending catch-up digest to chat {chat_id}: {e}")
+            reminder_failures.inc(chat_id=chat_id, kind="digest")
+            await ack_outbox([], keys, int(time.time()))
+            return
+        reminder_sends.inc(chat_id=chat_id, kind="digest")
+        sent_at = time.time()
+        for entry in entries:
+            reminder_lag.observe(max(0, sent_at - entry[3]), kind=entry[1])
+        pinned = False
+        if (await get_bot_rights(chat_id)).can_pin_messages:
             try:
-                due_datetime = datetime.fromisoformat(due_date.replace(' ', 'T', 1))
-            except ValueError:
-                continue
+                await bot.pin_chat_message(chat_id, msg.message_id)
+                pinned = True
+            except Exception:
+                pass
+        await ack_digest(chat_id, keys, msg.message_id, pinned, int(time.time()))
+        if len(entries) < CATCHUP_DIGEST_LIMIT:
+            return
 
-            offset = custom_offset if custom_offset is not None else {
-                'moscow': 3,
-                'ekb': 5,
-                'novosib': 7
-            }.get(timezone, 3)
+async def drain_chat_outbox(chat_id, catchup):
+    try:
+        if catchup:
+            # after downtime, fold the chat's backlog into one digest instead of a burst of pins
+            await send_catchup_digest(chat_id, int(time.time()))
+        while True:
+            chat_rerun.discard(chat_id)
+            entries = await get_pending_outbox(chat_id, int(time.time()), OUTBOX_BATCH)
+            if not entries:
+                if chat_id in chat_rerun:
+                    continue
+                return
+            assignees_by_task = await get_assignees_for({entry[0] for entry in entries})
+            sent = []
+            failed = []
+            for task_id, kind, _, fire_at, text, due_date, reminder_minutes in entries:
+                try:
+                    message_id, pinned = await send_outbox_entry(
+                        task_id, kind, chat_id, text, due_date, reminder_minutes,
+                        assignees_by_task[task_id]
+                    )
+                    sent.append((task_id, kind, chat_id, message_id, pinned))
+                    reminder_sends.inc(chat_id=chat_id, kind=kind)
+                    reminder_lag.observe(max(0, time.time() - fire_at), kind=kind)
+                except Exception as e:
+                    print(f"Error sending {kind} for task {task_id}: {e}")
+                    reminder_failures.inc(chat_id=chat_id, kind=kind)
+                    failed.append((task_id, kind))
+            await ack_outbox(sent, failed, int(time.time()))
+    except Exception as e:
+        print(f"Error draining reminder outbox for chat {chat_id}: {e}")
+    finally:
+        chat_senders.pop(chat_id, None)
+
+async def drain_outbox(shard=ALL_SHARDS):
+    # one sender per chat, so a rate limited chat doesn't hold up the others
+    now = int(time.time())
+    catchup = set(await get_catchup_chats(now, CATCHUP_THRESHOLD, CATCHUP_MIN_EVENTS, shard))
+    for chat_id in await get_outbox_chats(now, shard):
+        if chat_id in chat_senders:
+            chat_rerun.add(chat_id)
+        else:
+            chat_senders[chat_id] = asyncio.create_task(
+                drain_chat_outbox(chat_id, chat_id in catchup)
+            )
 
-            local_due_datetime = due_datetime + timedelta(hours=offset)
-            assignees = await get_assignees(task_id)
+async def deliver_reminders(task_ids, now, shard=ALL_SHARDS):
+    await claim_due_reminders(task_ids, now)
+    await drain_outbox(shard)
 
-            assignees_text = ' '.join(escape_html(a) for a in assignees) if assignees else "Нет"
-            safe_text = escape_html(text)
-            formatted_date = escape_html(local_due_datetime.strftime('%d.%m.%Y %H:%M'))
-
-            if reminder_minutes and reminder_minutes > 0:
-                reminder_time = due_datetime - timedelta(minutes=reminder_minutes)
-                if now_utc >= reminder_time and not notified:
-                    reminder_text = (
-                        f"⏰ <b>Напоминание за {reminder_minutes} мин</b>\n"
-                        f"📌 <b>Задача:</b> {safe_text}\n"
-                        f"🕒 <b>Время:</b> {formatted_date}\n"
-                        f"👥 <b>Исполнители:</b> {assignees_text}"
-                    )
-                    await send_and_track_message(
-                        chat_id,
-                        reminder_text,
-                        reply_markup=mk.confirmation_menu(task_id, reminder=True),
-                        task_id=task_id,
-                        parse_mode="HTML"
-                    )
-                    await update_task(task_id, notified=1)
-                    await asyncio.sleep(0.5)
-
-            if now_utc >= due_datetime and not main_notified:
-                main_text = (
-                    f"🔔 <b>Время выполнять!</b>\n"
-                    f"📌 <b>Задача:</b> {safe_text}\n"
-                    f"🕒 <b>Назначенное время:</b> {formatted_date}\n"
-                    f"👥 <b>Исполнители:</b> {assignees_text}"
-                )
-                msg = await bot.send_message(
-                    chat_id,
-                    main_text,
-                    reply_markup=mk.confirmation_menu(task_id, due=True),
-                    parse_mode="HTML"
-                )
-                try:
-                    await bot.pin_chat_message(chat_id, msg.message_id)
-                except Exception:
-                    pass
-                await add_bot_message(chat_id, msg.message_id, task_id)
-                await add_pinned_message(chat_id, msg.message_id, task_id)
-                await update_task(task_id, main_notified=1)
-                await asyncio.sleep(0.5)
+async def retry_outbox(shard=ALL_SHARDS):
+    while True:
+        try:
+            await drain_outbox(shard)
+        except Exception as e:
+            print(f"Error draining reminder outbox: {e}")
+        await asyncio.sleep(OUTBOX_RETRY_INTERVAL)
 
-        await asyncio.sleep(10)
+async def check_reminders(shard=ALL_SHARDS):
+    try:
+        await asyncio.gather(
+            reminder_scheduler.run(
+                partial(get_pending_events, shard=shard),
+                partial(deliver_reminders, shard=shard)
+            ),
+            retry_outbox(shard)
+        )
+    finally:
+        for task in list(chat_senders.values()):
+            task.cancel()
+
+async def leader_jobs():
+    jobs = [maintenance.run(), message_expiry.run()]
+    # with several shards reminders are sent by worker.py processes
+    if SCHEDULER_SHARDS <= 1:
+        jobs.append(check_reminders())
+    await asyncio.gather(*jobs)
+
+async def watch_external_changes():
+    # other instances share the database, pick up what they wrote
+    version = await get_data_version()
+    last_change = await get_last_change()
+    while True:
+        await asyncio.sleep(CHANGE_POLL_INTERVAL)
+        try:
+            current = await get_data_version()
+            if current == version:
+                continue
+            version = current
+            changes = await get_changes(last_change, CHANGE_LOG_BATCH)
+            if len(changes) == CHANGE_LOG_BATCH or (changes and changes[0][0] > last_change + 1):
+                # too far behind or the log was purged past us, reload everything
+                last_change = await get_last_change()
+                reminder_scheduler.resync()
+                message_expiry.wake()
+                storage.invalidate()
+                await load_chat_timezones()
+                continue
+            changed = {}
+            for seq, scope, key in changes:
+                changed.setdefault(scope, set()).add(key)
+                last_change = seq
+            for task_id in changed.get("tasks", ()):
+                reminder_scheduler.notify(task_id)
+            if "message_expiry" in changed:
+                message_expiry.wake()
+            if "fsm_storage" in changed:
+                storage.invalidate(changed["fsm_storage"])
+            if "group_timezones" in changed:
+                await load_chat_timezones()
+        except Exception as e:
+            print(f"Error checking database changes: {e}")
+
+@router.callback_query()
+async def callback_query_handler(callback: types.CallbackQuery, **data):
+    handler, callback_data = callback_router.resolve(callback.data or "")
+    if handler is None:
+        await callback.answer()
+        return
+    set_handler_name(handler.callback.__name__)
+    return await handler.call(callback, callback_data=callback_data, **data)
 
+dp.update.outer_middleware(ChatContextMiddleware())
 dp.include_router(router)
 
+async def run_polling():
+    await bot.delete_webhook()
+    # updates are handed to chat_executor, which applies backpressure to the polling loop
+    await dp.start_polling(bot, handle_as_tasks=False)
+
+async def run_webhook():
+    app = web.Application()
+    # on_shutdown hooks run in order, drain and flush in emit_shutdown before the session is closed
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+        handle_in_background=False
+    ).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+        print(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     await init_db()
-    reminders_task = None
+    background_tasks = []
+    metrics_runner = None
     try:
-        reminders_task = asyncio.create_task(check_reminders())
+        if METRICS_PORT:
+            metrics_runner = await serve_metrics(metrics, METRICS_PORT)
+        background_tasks.append(asyncio.create_task(leader_lease.run(leader_jobs)))
+        background_tasks.append(asyncio.create_task(watch_external_changes()))
         print("Бот запущен")
-        await dp.start_polling(bot)
+        if DELIVERY_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
     finally:
-        if reminders_task:
-            reminders_task.cancel()
+        for task in background_tasks:
+            task.cancel()
             try:
-                await reminders_task
+                await task
             except asyncio.CancelledError:
                 pass
+        await chat_executor.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
         await close_db()
 
 if __name__ == "__main__":
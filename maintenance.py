@@ -0,0 +1,83 @@
+from config import (
+    MAINTENANCE_INTERVAL, MAINTENANCE_BATCH, MAINTENANCE_PAUSE, TASK_RETENTION, CHANGE_LOG_RETENTION
+)
+from aiogram.exceptions import TelegramRetryAfter
+from dp import (
+    TASK_DEPENDENTS, purge_expired_tasks, purge_orphans, purge_changes, get_orphan_bot_messages,
+    delete_chat_messages, delete_bot_messages
+)
+import asyncio
+import time
+
+
+class Maintenance:
+    def __init__(self, interval=MAINTENANCE_INTERVAL, batch_size=MAINTENANCE_BATCH,
+                 pause=MAINTENANCE_PAUSE, retention=TASK_RETENTION, change_retention=CHANGE_LOG_RETENTION):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.retention = retention
+        self.change_retention = change_retention
+
+    async def purge_tasks(self, removed):
+        before = int(time.time()) - self.retention
+        while True:
+            batch = await purge_expired_tasks(before, self.batch_size)
+            for table, count in batch.items():
+                removed[table] = removed.get(table, 0) + count
+            if batch["tasks"] < self.batch_size:
+                return
+            # give the handlers a chance at the write lock between batches
+            await asyncio.sleep(self.pause)
+
+    async def purge_orphans(self, removed):
+        for table in TASK_DEPENDENTS:
+            while True:
+                count = await purge_orphans(table, self.batch_size)
+                removed[table] = removed.get(table, 0) + count
+                if count < self.batch_size:
+                    break
+                await asyncio.sleep(self.pause)
+
+    async def purge_orphan_messages(self, removed):
+        while True:
+            rows = await get_orphan_bot_messages(self.batch_size)
+            by_chat = {}
+            for chat_id, message_id in rows:
+                by_chat.setdefault(chat_id, []).append(message_id)
+            throttled = False
+            for chat_id, message_ids in by_chat.items():
+                failed = await delete_chat_messages(chat_id, message_ids)
+                # rate limited deletes are retried on the next run, other failures never succeed
+                retry = {m for m, error in failed.items() if isinstance(error, TelegramRetryAfter)}
+                throttled = throttled or bool(retry)
+                done = [m for m in message_ids if m not in retry]
+                await delete_bot_messages(chat_id, done)
+                removed["bot_messages"] = removed.get("bot_messages", 0) + len(done)
+            if throttled or len(rows) < self.batch_size:
+                return
+            await asyncio.sleep(self.pause)
+
+    async def run_once(self):
+        removed = {}
+        await self.purge_tasks(removed)
+        await self.purge_orphans(removed)
+        await self.purge_orphan_messages(removed)
+        removed["data_changes"] = await purge_changes(int(time.time()) - self.change_retention)
+        report = ", ".join(f"{table}: {count}" for table, count in removed.items() if count)
+        if report:
+            print(f"Maintenance removed {report}")
+        return removed
+
+    async def run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Maintenance error: {e}")
+            await asyncio.sleep(self.interval)
+
+
+maintenance = Maintenance()
@@ -1,150 +1,211 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.utils.keyboard import InlineKeyboardBuilder
+from pydantic import ConfigDict
+import callbacks as cb
 
+ROW_WIDTH = 8
 
-def private_menu():
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(
-            text="➕ Добавить в группу",
-            url="https://t.me/TaskSnap_bot?startgroup=true"
+
+class FrozenButton(InlineKeyboardButton):
+    # buttons are shared between markups, so they must not be changed in place
+    model_config = ConfigDict(**{**InlineKeyboardButton.model_config, "frozen": True})
+
+
+_BUTTON = FrozenButton(text="", callback_data="")
+_MARKUP = InlineKeyboardMarkup(inline_keyboard=[])
+
+
+# copying a validated prototype is several times cheaper than building or even model_construct()
+def button(text, callback_data=None, **kwargs):
+    if kwargs:
+        return FrozenButton(text=text, callback_data=callback_data, **kwargs)
+    return _BUTTON.model_copy(update={"text": text, "callback_data": callback_data})
+
+
+def markup(rows):
+    # every call gets its own lists, the buttons in them are frozen
+    return _MARKUP.model_copy(update={"inline_keyboard": [list(row) for row in rows]})
+
+
+def frozen_rows(rows):
+    return tuple(tuple(row) for row in rows)
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class KeyboardTemplate:
+    def __init__(self, rows):
+        # rows of (text, callback_data format string) pairs, each compiled into a ready button
+        self.rows = tuple(
+            tuple((button(text, data), text if "{" in text else None, data) for text, data in row)
+            for row in rows
         )
-    )
-    builder.adjust(1)
-    return builder.as_markup()
+
+    def render(self, **values):
+        rows = []
+        for row in self.rows:
+            buttons = []
+            for prototype, text, data in row:
+                update = {"callback_data": data.format(**values)}
+                if text is not None:
+                    update["text"] = text.format(**values)
+                buttons.append(prototype.model_copy(update=update))
+            rows.append(buttons)
+        return markup(rows)
+
+
+_PRIVATE_MENU = frozen_rows([
+    [button("➕ Добавить в группу", url="https://t.me/TaskSnap_bot?startgroup=true")],
+])
+
+_GROUP_MENU = frozen_rows([[
+    button("➕ Создать задачу", cb.CreateTask().pack()),
+    button("📋 Все задачи", cb.ListTasks().pack()),
+    button("🗑 Удалить всё", cb.DeleteAll().pack()),
+]])
+
+_TIMEZONE_MENU = frozen_rows([
+    [button("Екатеринбург (UTC+5)", cb.Timezone(choice="ekb").pack())],
+    [button("Москва (UTC+3)", cb.Timezone(choice="moscow").pack())],
+    [button("Новосибирск (UTC+7)", cb.Timezone(choice="novosib").pack())],
+    [button("⏳ Указать вручную", cb.Timezone(choice="custom").pack())],
+    [button("🔙 Назад", cb.MainMenu().pack())],
+])
+
+_CANCEL_TIMEZONE_MENU = frozen_rows([
+    [button("❌ Отменить", cb.Timezone(choice="change").pack())],
+])
+
+_DELETE_ALL_CONFIRMATION = frozen_rows([[
+    button("✅ Да, удалить все", cb.ConfirmDeleteAll().pack()),
+    button("❌ Нет, отменить", cb.ListTasks().pack()),
+]])
+
+_EMPTY = ()
+
+_TIMEZONE_CONFIRMATION = KeyboardTemplate([
+    [("✅ Да, установить {timezone_name} ({time_str})", cb.Timezone(choice="confirm").pack())],
+    [("❌ Нет, выбрать другой", cb.Timezone(choice="change").pack())],
+])
+
+REMINDER_PERIODS = [
+    (1440, "За сутки"),
+    (360, "За 6 часов"),
+    (180, "За 3 часа"),
+    (120, "За 2 часа"),
+    (60, "За 1 час"),
+    (30, "За 30 мин"),
+    (10, "За 10 мин"),
+    (5, "За 5 мин"),
+    (0, "❌ Без напоминания"),
+]
+
+_REMINDER_MENU = KeyboardTemplate(chunks(
+    [(text, cb.template(cb.SetReminder, minutes=minutes)) for minutes, text in REMINDER_PERIODS], 2
+))
+
+_TASK_ACTIONS = [
+    [("⌛️ Перенести дату", cb.template(cb.Reschedule))],
+    [("➕ Изменить напоминание", cb.template(cb.AddReminder))],
+    [("🗑 Удалить", cb.template(cb.DeleteTask))],
+]
+_TASK_ACTIONS_MENU = KeyboardTemplate(_TASK_ACTIONS + [[("🔙 Назад к списку", cb.ListTasks().pack())]])
+_TASK_ACTIONS_MENU_NO_BACK = KeyboardTemplate(_TASK_ACTIONS)
+
+_EDIT_OPTIONS_MENU = KeyboardTemplate([
+    [("✏️ Текст", cb.template(cb.EditText)), ("📅 Дата", cb.template(cb.EditDate))],
+    [("🔙 Назад", cb.template(cb.ViewTask))],
+])
+
+_ASSIGNEE_MENU = KeyboardTemplate([[
+    ("✅ Продолжить", cb.template(cb.ContinueAssignees)),
+    ("➕ Добавить еще", cb.template(cb.AddAssignee)),
+]])
+
+_ASSIGNEE_CHOICE_MENU = KeyboardTemplate([[
+    ("✅ Да", cb.template(cb.WithAssignee)),
+    ("❌ Нет", cb.template(cb.WithoutAssignee)),
+]])
+
+_CONFIRMATION_MENU = KeyboardTemplate([[("✅ Я помню", cb.template(cb.ConfirmTask))]])
+
+_VIEW_TASK = cb.template(cb.ViewTask)
+_TASKS_PAGE = cb.template(cb.TasksPage)
+_CONFIRM_TASK = cb.template(cb.ConfirmTask)
+_MAIN_MENU_BUTTON = button("🏠 Главное меню", cb.MainMenu().pack())
+_TIMEZONE_ROW = (button("🕒 Сменить часовой пояс", cb.ChangeTimezone().pack()),)
+_CONFIRM_DIGEST_ROW = (button("✅ Подтвердить все", cb.ConfirmDigest().pack()),)
+
+
+def private_menu():
+    return markup(_PRIVATE_MENU)
 
 
 def group_menu():
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="➕ Создать задачу", callback_data="create_task"),
-        InlineKeyboardButton(text="📋 Все задачи", callback_data="list_tasks"),
-        InlineKeyboardButton(text="🗑 Удалить всё", callback_data="delete_all")
-    )
-    builder.adjust(3, 1)
-    return builder.as_markup()
+    return markup(_GROUP_MENU)
 
 
 def timezone_menu(current_time_str):
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="Екатеринбург (UTC+5)", callback_data="tz_ekb"),
-        InlineKeyboardButton(text="Москва (UTC+3)", callback_data="tz_moscow"),
-        InlineKeyboardButton(text="Новосибирск (UTC+7)", callback_data="tz_novosib"),
-        InlineKeyboardButton(text="⏳ Указать вручную", callback_data="tz_custom"),
-        InlineKeyboardButton(text="🔙 Назад", callback_data="main_menu")
-    )
-    builder.adjust(1)
-    return builder.as_markup()
+    return markup(_TIMEZONE_MENU)
 
 
 def timezone_confirmation_menu(timezone_name, time_str):
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(
-            text=f"✅ Да, установить {timezone_name} ({time_str})",
-            callback_data="tz_confirm"
-        ),
-        InlineKeyboardButton(
-            text="❌ Нет, выбрать другой",
-            callback_data="tz_change"
-        )
-    )
-    builder.adjust(1)
-    return builder.as_markup()
+    return _TIMEZONE_CONFIRMATION.render(timezone_name=timezone_name, time_str=time_str)
 
 
 def cancel_timezone_menu():
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="❌ Отменить", callback_data="tz_change")
-    )
-    return builder.as_markup()
+    return markup(_CANCEL_TIMEZONE_MENU)
 
 
 def reminder_menu(task_id):
-    periods = [
-        (1440, "За сутки"),
-        (360, "За 6 часов"),
-        (180, "За 3 часа"),
-        (120, "За 2 часа"),
-        (60, "За 1 час"),
-        (30, "За 30 мин"),
-        (10, "За 10 мин"),
-        (5, "За 5 мин")
-    ]
-    builder = InlineKeyboardBuilder()
-    for minutes, text in periods:
-        builder.add(InlineKeyboardButton(text=text, callback_data=f"remind_{minutes}_{task_id}"))
-    builder.add(InlineKeyboardButton(text="❌ Без напоминания", callback_data=f"remind_0_{task_id}"))
-    builder.adjust(2)
-    return builder.as_markup()
-
-
-def tasks_pagination_menu(tasks, page=0, tasks_per_page=2):
-    builder = InlineKeyboardBuilder()
-    for task in tasks[page * tasks_per_page : (page + 1) * tasks_per_page]:
-        task_id = task[0]
-        builder.add(InlineKeyboardButton(text=f"#{task_id}", callback_data=f"view_{task_id}"))
-    
+    return _REMINDER_MENU.render(task_id=task_id)
+
+
+def tasks_pagination_menu(tasks, page=0, has_prev=False, has_next=False, timezone_row=False):
+    rows = chunks([button(f"#{task[0]}", _VIEW_TASK.format(task_id=task[0])) for task in tasks], ROW_WIDTH)
+
     pagination_buttons = []
-    if page > 0:
-        pagination_buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=f"tasks_page_{page - 1}"))
-    
-    pagination_buttons.append(InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu"))
-    
-    if (page + 1) * tasks_per_page < len(tasks):
-        pagination_buttons.append(InlineKeyboardButton(text="Вперед ▶️", callback_data=f"tasks_page_{page + 1}"))
-    
-    builder.row(*pagination_buttons)
-    return builder.as_markup()
+    if has_prev:
+        pagination_buttons.append(button("◀️ Назад", _TASKS_PAGE.format(page=page - 1)))
+    pagination_buttons.append(_MAIN_MENU_BUTTON)
+    if has_next:
+        pagination_buttons.append(button("Вперед ▶️", _TASKS_PAGE.format(page=page + 1)))
+    rows.append(pagination_buttons)
+
+    if timezone_row:
+        rows.append(_TIMEZONE_ROW)
+    return markup(rows)
 
 
 def task_actions_menu(task_id, show_back=True):
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="⌛️ Перенести дату", callback_data=f"reschedule_{task_id}"),
-        InlineKeyboardButton(text="➕ Изменить напоминание", callback_data=f"add_reminder_{task_id}"),
-        InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_{task_id}")
-    )
-    if show_back:
-        builder.add(InlineKeyboardButton(text="🔙 Назад к списку", callback_data="list_tasks"))
-    builder.adjust(1)
-    return builder.as_markup()
+    template = _TASK_ACTIONS_MENU if show_back else _TASK_ACTIONS_MENU_NO_BACK
+    return template.render(task_id=task_id)
+
+
+def edit_options_menu(task_id):
+    return _EDIT_OPTIONS_MENU.render(task_id=task_id)
 
 
 def delete_all_confirmation():
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="✅ Да, удалить все", callback_data="confirm_delete_all"),
-        InlineKeyboardButton(text="❌ Нет, отменить", callback_data="list_tasks")
-    )
-    return builder.as_markup()
+    return markup(_DELETE_ALL_CONFIRMATION)
 
 
 def assignee_menu(task_id):
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="✅ Продолжить", callback_data=f"continue_{task_id}"),
-        InlineKeyboardButton(text="➕ Добавить еще", callback_data=f"add_more_1_{task_id}")
-    )
-    return builder.as_markup()
+    return _ASSIGNEE_MENU.render(task_id=task_id)
 
 
 def assignee_choice_menu(task_id):
-    builder = InlineKeyboardBuilder()
-    builder.add(
-        InlineKeyboardButton(text="✅ Да", callback_data=f"with_assignee_{task_id}"),
-        InlineKeyboardButton(text="❌ Нет", callback_data=f"without_assignee_{task_id}")
-    )
-    return builder.as_markup()
+    return _ASSIGNEE_CHOICE_MENU.render(task_id=task_id)
 
 
 def confirmation_menu(task_id, reminder=False, due=False):
-    builder = InlineKeyboardBuilder()
     if reminder or due:
-        builder.add(
-            InlineKeyboardButton(text="✅ Я помню", callback_data=f"confirm_{task_id}")
-        )
-    builder.adjust(1)
-    return builder.as_markup()
+        return _CONFIRMATION_MENU.render(task_id=task_id)
+    return markup(_EMPTY)
+
+
+def digest_menu(task_ids):
+    rows = chunks([button(f"✅ #{task_id}", _CONFIRM_TASK.format(task_id=task_id)) for task_id in task_ids], 4)
+    rows.append(_CONFIRM_DIGEST_ROW)
+    return markup(rows)
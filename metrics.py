@@ -0,0 +1,146 @@
+from aiohttp import web
+from bisect import bisect_left
+from collections import deque
+from config import METRICS_HOST
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, key)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # per-bucket counts, then sum and count
+            entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_labels(self.labels, key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {count}"
+
+
+class Summary:
+    kind = "summary"
+
+    def __init__(self, name, help, labels=(), quantiles=(0.5, 0.95, 0.99), window=1000):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.quantiles = quantiles
+        self.window = window
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        entry = self._values.get(key)
+        if entry is None:
+            # rolling window of recent values, then lifetime sum and count
+            entry = self._values[key] = [deque(maxlen=self.window), 0.0, 0]
+        entry[0].append(value)
+        entry[1] += value
+        entry[2] += 1
+
+    def percentiles(self, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        entry = self._values.get(key)
+        if not entry:
+            return {}
+        recent = sorted(entry[0])
+        return {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in self.quantiles}
+
+    def samples(self):
+        for key, (recent, total, count) in sorted(self._values.items()):
+            labels = dict(zip(self.labels, key))
+            for q, value in self.percentiles(**labels).items():
+                yield f"{self.name}{_labels(self.labels, key, [('quantile', q)])} {value}"
+            yield f"{self.name}_sum{_labels(self.labels, key)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, key)} {count}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, cls, name, help, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, help, **kwargs)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels=labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels=labels, buckets=buckets)
+
+    def summary(self, name, help, labels=(), quantiles=(0.5, 0.95, 0.99), window=1000):
+        return self._register(Summary, name, help, labels=labels, quantiles=quantiles, window=window)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(registry, port, host=METRICS_HOST):
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,111 @@
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from config import (
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_GROUP_BURST,
+    OUTBOUND_PRIVATE_RATE, OUTBOUND_MAX_RETRIES, SCHEDULER_SHARDS
+)
+import asyncio
+import random
+import time
+
+SEND_METHOD_PREFIXES = ("Send", "Copy", "Forward")
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self):
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.capacity
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, group_rate=OUTBOUND_GROUP_RATE / 60,
+                 group_burst=OUTBOUND_GROUP_BURST, private_rate=OUTBOUND_PRIVATE_RATE,
+                 max_retries=OUTBOUND_MAX_RETRIES):
+        self.set_global_rate(global_rate)
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+
+    def set_global_rate(self, rate):
+        self.global_bucket = TokenBucket(rate, max(1, rate))
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items() if not value.idle()
+                }
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, 1)
+            else:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def throttle(self, chat_id, is_send):
+        bucket = self.chat_bucket(chat_id)
+        if is_send:
+            wait = bucket.reserve()
+        else:
+            # edits and deletes are not rate counted but still honour a retry_after block
+            wait = bucket.blocked_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        wait = self.global_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        is_send = type(method).__name__.startswith(SEND_METHOD_PREFIXES)
+        attempt = 0
+        while True:
+            if chat_id is not None:
+                await self.throttle(chat_id, is_send)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = e.retry_after + random.uniform(0.1, 1.0)
+                if chat_id is not None:
+                    self.chat_bucket(chat_id).block(delay)
+                else:
+                    await asyncio.sleep(delay)
+            except (TelegramNetworkError, TelegramServerError):
+                # a failed send may still have been delivered, only retry idempotent calls
+                if attempt >= self.max_retries or is_send or chat_id is None:
+                    raise
+                await asyncio.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt += 1
+
+
+def shard_global_rate(shards):
+    # the bot and every shard worker send with one token, so they split the bot-wide limit
+    return OUTBOUND_GLOBAL_RATE / (shards + 1)
+
+
+outbound_limiter = OutboundLimiter(
+    shard_global_rate(SCHEDULER_SHARDS) if SCHEDULER_SHARDS > 1 else OUTBOUND_GLOBAL_RATE
+)
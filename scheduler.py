@@ -0,0 +1,98 @@
+from config import SCHEDULER_RESYNC_INTERVAL, SCHEDULER_RETRY_DELAY
+from metrics import metrics
+import asyncio
+import heapq
+import time
+
+tick_seconds = metrics.histogram("scheduler_tick_seconds", "Time spent in one scheduler tick")
+events_scanned = metrics.histogram(
+    "scheduler_events_scanned", "Events loaded from the database per tick",
+    buckets=(0, 1, 10, 100, 1000, 10000, 100000)
+)
+due_events = metrics.counter("scheduler_due_tasks_total", "Tasks handed to delivery")
+
+
+class ReminderScheduler:
+    def __init__(self, resync_interval=SCHEDULER_RESYNC_INTERVAL, retry_delay=SCHEDULER_RETRY_DELAY):
+        self.resync_interval = resync_interval
+        self.retry_delay = retry_delay
+        self._heap = []
+        self._changed = set()
+        self._resync = False
+        self._wakeup = asyncio.Event()
+
+    def notify(self, task_id):
+        self._changed.add(int(task_id))
+        self._wakeup.set()
+
+    def resync(self):
+        self._resync = True
+        self._wakeup.set()
+
+    def _push(self, events):
+        for task_id, fire_at, kind in events:
+            heapq.heappush(self._heap, (fire_at, task_id, kind))
+
+    def _pop_due(self, now):
+        task_ids = set()
+        while self._heap and self._heap[0][0] <= now:
+            task_ids.add(heapq.heappop(self._heap)[1])
+        return task_ids
+
+    async def _reload(self, load_events, task_ids, now, delay_overdue=False):
+        events = [event for event in await load_events(task_ids) if event[1] is not None]
+        if delay_overdue:
+            events = [
+                (task_id, max(fire_at, now + self.retry_delay), kind)
+                for task_id, fire_at, kind in events
+            ]
+        self._push(events)
+        return len(events)
+
+    async def run(self, load_events, deliver):
+        next_resync = 0
+        while True:
+            self._wakeup.clear()
+            started = time.monotonic()
+            now = int(time.time())
+            scanned = 0
+            try:
+                if now >= next_resync or self._resync:
+                    self._heap = []
+                    self._changed.clear()
+                    self._resync = False
+                    scanned += await self._reload(load_events, None, now)
+                    next_resync = now + self.resync_interval
+                elif self._changed:
+                    changed = list(self._changed)
+                    self._changed.clear()
+                    scanned += await self._reload(load_events, changed, now)
+
+                due = self._pop_due(now)
+                if due:
+                    due_events.inc(len(due))
+                    await deliver(sorted(due), now)
+                    scanned += await self._reload(load_events, list(due), now, delay_overdue=True)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Reminder scheduler error: {e}")
+                next_resync = 0
+                await asyncio.sleep(self.retry_delay)
+                continue
+            tick_seconds.observe(time.monotonic() - started)
+            events_scanned.observe(scanned)
+
+            now = time.time()
+            timeout = next_resync - now
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+            if timeout <= 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+reminder_scheduler = ReminderScheduler()
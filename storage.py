@@ -0,0 +1,164 @@
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from collections import OrderedDict
+from config import FSM_CACHE_SIZE, FSM_TTL, FSM_FLUSH_INTERVAL
+import asyncio
+import json
+import time
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, pool, cache_size=FSM_CACHE_SIZE, ttl=FSM_TTL, flush_interval=FSM_FLUSH_INTERVAL):
+        self.pool = pool
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._cache = OrderedDict()
+        self._evicted = {}
+        self._dirty = set()
+        self._flushing = {}
+        self._flush_task = None
+        self._next_purge = 0
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    def _expired(self, entry):
+        return time.time() - entry[2] > self.ttl
+
+    def _installed(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = self._evicted.pop(key, None)
+        if entry is None:
+            # written by a flush that has not committed yet, the row in the db is still stale
+            entry = self._flushing.get(key)
+        return entry
+
+    async def _entry(self, key):
+        key = self._key(key)
+        entry = self._installed(key)
+        if entry is None:
+            async with self.pool.reader() as conn:
+                async with conn.execute(
+                    "SELECT state, data, updated_at FROM fsm_storage WHERE key=?", (key,)
+                ) as cursor:
+                    row = await cursor.fetchone()
+            # a concurrent miss on the same key may have installed and changed it meanwhile
+            entry = self._installed(key)
+        if entry is None:
+            if row:
+                entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+            else:
+                entry = [None, {}, time.time()]
+        if self._expired(entry):
+            entry = [None, {}, time.time()]
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        self._evict()
+        return key, entry
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            key, entry = self._cache.popitem(last=False)
+            if key in self._dirty:
+                self._evicted[key] = entry
+
+    def _touch(self, key, entry):
+        entry[2] = time.time()
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key, state=None):
+        key, entry = await self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(key, entry)
+
+    async def get_state(self, key):
+        _, entry = await self._entry(key)
+        return entry[0]
+
+    async def set_data(self, key, data):
+        key, entry = await self._entry(key)
+        entry[1] = data.copy()
+        self._touch(key, entry)
+
+    async def get_data(self, key):
+        _, entry = await self._entry(key)
+        return entry[1].copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys = list(self._dirty)
+        self._dirty.clear()
+        entries = {}
+        upserts = []
+        deletes = []
+        for key in keys:
+            entry = self._evicted.pop(key, None) or self._cache.get(key)
+            if entry is None:
+                continue
+            entries[key] = entry
+            if entry[0] is None and not entry[1]:
+                deletes.append((key,))
+            else:
+                upserts.append((key, entry[0], json.dumps(entry[1]), int(entry[2])))
+        self._flushing = entries
+        try:
+            async with self.pool.writer() as conn:
+                await conn.executemany(
+                    "INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                    upserts
+                )
+                await conn.executemany("DELETE FROM fsm_storage WHERE key=?", deletes)
+                await conn.commit()
+        except Exception:
+            for key, entry in entries.items():
+                if key not in self._cache:
+                    self._evicted[key] = entry
+            self._dirty.update(entries)
+            raise
+        finally:
+            self._flushing = {}
+
+    def invalidate(self, keys=None):
+        keys = list(self._cache) if keys is None else [key for key in keys if key in self._cache]
+        for key in keys:
+            if key not in self._dirty:
+                del self._cache[key]
+
+    async def purge_expired(self):
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM fsm_storage WHERE updated_at < ?",
+                (int(time.time() - self.ttl),)
+            )
+            await conn.commit()
+        for key in [key for key, entry in self._cache.items() if self._expired(entry)]:
+            if key not in self._dirty:
+                del self._cache[key]
+        return cursor.rowcount
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() >= self._next_purge:
+                    await self.purge_expired()
+                    self._next_purge = time.time() + self.ttl / 10
+            except Exception as e:
+                print(f"Error flushing FSM storage: {e}")
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
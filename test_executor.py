@@ -0,0 +1,119 @@
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.filters import StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from datetime import datetime
+from executor import ChatExecutor
+import asyncio
+
+USER = types.User(id=1, is_bot=False, first_name="user")
+
+
+class Form(StatesGroup):
+    waiting = State()
+
+
+def message_update(update_id, chat_id, text):
+    return types.Update(update_id=update_id, message=types.Message(
+        message_id=update_id, date=datetime.now(), chat=types.Chat(id=chat_id, type="group"),
+        from_user=USER, text=text
+    ))
+
+
+def callback_update(update_id, chat_id, data):
+    return types.Update(update_id=update_id, callback_query=types.CallbackQuery(
+        id=str(update_id), from_user=USER, chat_instance="test", data=data,
+        message=types.Message(message_id=update_id, date=datetime.now(), chat=types.Chat(id=chat_id, type="group"))
+    ))
+
+
+def make_dispatcher(router, **kwargs):
+    dispatcher = Dispatcher()
+    executor = ChatExecutor(**kwargs)
+    executor.setup(dispatcher)
+    dispatcher.include_router(router)
+    return dispatcher, executor, Bot("42:TEST")
+
+
+def test_queued_update_sees_state_set_by_previous_update():
+    router = Router()
+    seen = []
+
+    @router.callback_query(F.data == "create")
+    async def create(callback: types.CallbackQuery, state: FSMContext):
+        await asyncio.sleep(0.05)
+        await state.set_state(Form.waiting)
+
+    @router.message(StateFilter(Form.waiting))
+    async def waiting(message: types.Message, raw_state):
+        seen.append(("waiting", raw_state))
+
+    @router.message()
+    async def stateless(message: types.Message, raw_state):
+        seen.append(("stateless", raw_state))
+
+    async def run():
+        dispatcher, executor, bot = make_dispatcher(router)
+        await dispatcher.feed_update(bot, callback_update(1, -1, "create"))
+        await dispatcher.feed_update(bot, message_update(2, -1, "task"))
+        await executor.close()
+
+    asyncio.run(run())
+    assert seen == [("waiting", Form.waiting.state)]
+
+
+def test_busy_chat_keeps_messages_and_answers_dropped_callbacks():
+    router = Router()
+    gate = asyncio.Event()
+    handled = []
+
+    @router.message()
+    async def slow(message: types.Message):
+        await gate.wait()
+        handled.append(message.chat.id)
+
+    @router.callback_query()
+    async def tap(callback: types.CallbackQuery):
+        handled.append(callback.data)
+
+    async def run():
+        dispatcher, executor, bot = make_dispatcher(router, max_pending=4, chat_max_pending=2, chat_max_queued=2)
+        answered = []
+
+        async def answer_callback_query(callback_query_id, **kwargs):
+            answered.append(callback_query_id)
+
+        bot.answer_callback_query = answer_callback_query
+        for update_id in range(1, 6):
+            await asyncio.wait_for(dispatcher.feed_update(bot, message_update(update_id, -1, "flood")), 1)
+        await asyncio.wait_for(dispatcher.feed_update(bot, callback_update(6, -1, "tap")), 1)
+        # another chat still gets a slot while -1 is busy
+        await asyncio.wait_for(dispatcher.feed_update(bot, message_update(7, -2, "other")), 1)
+        gate.set()
+        await executor.close()
+        assert answered == ["6"]
+        assert executor._held == {} and executor._overflow == {}
+
+    asyncio.run(run())
+    assert handled.count(-1) == 5 and -2 in handled and "tap" not in handled
+
+
+def test_handler_errors_reach_dispatcher_error_handlers():
+    router = Router()
+    errors = []
+
+    @router.message()
+    async def boom(message: types.Message):
+        raise ValueError("boom")
+
+    @router.errors()
+    async def on_error(event: types.ErrorEvent):
+        errors.append(event.exception)
+
+    async def run():
+        dispatcher, executor, bot = make_dispatcher(router)
+        await dispatcher.feed_update(bot, message_update(1, -1, "boom"))
+        await executor.close()
+
+    asyncio.run(run())
+    assert [type(e) for e in errors] == [ValueError]
@@ -0,0 +1,46 @@
+from config import SCHEDULER_SHARDS
+from dp import Shard, init_db, close_db
+from functools import partial
+from leader import LeaderLease
+from main import check_reminders, watch_external_changes
+from metrics import metrics, serve_metrics
+from outbound import outbound_limiter, shard_global_rate
+import argparse
+import asyncio
+
+
+async def run_shard(shard, metrics_port=0):
+    outbound_limiter.set_global_rate(shard_global_rate(shard.count))
+    await init_db()
+    metrics_runner = await serve_metrics(metrics, metrics_port) if metrics_port else None
+    lease = LeaderLease(f"shard:{shard.index}/{shard.count}")
+    background_tasks = [
+        asyncio.create_task(lease.run(partial(check_reminders, shard))),
+        asyncio.create_task(watch_external_changes())
+    ]
+    print(f"Шард {shard.index}/{shard.count} запущен")
+    try:
+        await asyncio.gather(*background_tasks)
+    finally:
+        for task in background_tasks:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reminder scheduler shard")
+    parser.add_argument("--shard", type=int, required=True)
+    parser.add_argument("--metrics-port", type=int, default=0)
+    args = parser.parse_args()
+    # the shard count must match the bot's, otherwise its leader keeps sending every chat too
+    if SCHEDULER_SHARDS <= 1:
+        parser.error("set SCHEDULER_SHARDS in config.py above 1 to run shard workers")
+    if not 0 <= args.shard < SCHEDULER_SHARDS:
+        parser.error(f"--shard must be between 0 and {SCHEDULER_SHARDS - 1}")
+    asyncio.run(run_shard(Shard(args.shard, SCHEDULER_SHARDS), args.metrics_port))